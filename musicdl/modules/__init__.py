@@ -3,7 +3,9 @@ from .sources import (
     MusicClientBuilder, BuildMusicClient
 )
 from .utils import (
-    BaseModuleBuilder, LoggerHandle, AudioLinkTester, WhisperLRC, colorize, printtable, legalizestring, touchdir, seconds2hms, byte2mb, 
+    BaseModuleBuilder, LoggerHandle, AudioLinkTester, WhisperLRC, MusicLibrary, BloomFilter, BandwidthLimiter, GLOBAL_BANDWIDTH_LIMITER, DownloadQueue, BaseEventSink, RichEventSink, JSONLinesEventSink, NullEventSink,
+    EventSinkBuilder, BuildEventSink, StealableTransfer, WorkStealingScheduler, QualityLadderResolver, LinkTestCache, CircuitBreaker, LyricCache, SegmentFetcher,
+    colorize, printtable, legalizestring, touchdir, seconds2hms, byte2mb, mb2byte, 
     cachecookies, resp2json, isvalidresp, safeextractfromdict, replacefile, printfullline, smarttrunctable, usesearchheaderscookies,
     usedownloadheaderscookies, useparseheaderscookies,
 )
\ No newline at end of file
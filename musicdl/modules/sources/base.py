@@ -7,24 +7,39 @@ WeChat Official Account (微信公众号):
     Charles的皮卡丘
 '''
 import os
+import re
+import sys
 import copy
 import pickle
+import random
+import hashlib
 import requests
+import threading
 from datetime import datetime
 from freeproxy import freeproxy
 from fake_useragent import UserAgent
 from pathvalidate import sanitize_filepath
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from ..utils import LoggerHandle, touchdir, usedownloadheaderscookies, usesearchheaderscookies
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn, DownloadColumn, TransferSpeedColumn, TimeRemainingColumn, MofNCompleteColumn
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from ..utils import (
+    LoggerHandle, MusicLibrary, DownloadQueue, AudioLinkTester, BaseEventSink, NullEventSink, EventSinkBuilder, StealableTransfer, WorkStealingScheduler,
+    QualityLadderResolver, LinkTestCache, CircuitBreaker, GLOBAL_BANDWIDTH_LIMITER, touchdir, mb2byte, safeextractfromdict, usedownloadheaderscookies, usesearchheaderscookies
+)
 
 
 '''BaseMusicClient'''
 class BaseMusicClient():
     source = 'BaseMusicClient'
+    # auth query params that change on every resolution of the same audio file, stripped from link test cache keys
+    volatile_url_params = ()
+    # sources whose next search page needs a cursor from the previous response implement _fetchsearchpage and accept search_payload in _search
+    cursor_paging = False
     def __init__(self, search_size_per_source: int = 5, auto_set_proxies: bool = False, random_update_ua: bool = False, max_retries: int = 5, maintain_session: bool = False, 
                  logger_handle: LoggerHandle = None, disable_print: bool = False, work_dir: str = 'musicdl_outputs', proxy_sources: list = None, default_search_cookies: dict = None,
-                 default_download_cookies: dict = None):
+                 default_download_cookies: dict = None, library_dir: str = None, bandwidth_limit: int = None, enable_download_queue: bool = True,
+                 download_queue_path: str = None, event_sink=None, enable_work_stealing: bool = True, min_steal_segment_size: int = 4194304,
+                 quality_ladder_top_k: int = 3, link_test_cache_ttl: float = 600, link_test_cache_size: int = 4096,
+                 link_validation: str = 'always', link_validation_sample_rate: float = 0.1, boost_mode: str = 'download', boost_timeout: float = 15,
+                 boost_failure_threshold: int = 5, boost_recovery_timeout: float = 60):
         # set up work dir
         touchdir(work_dir)
         # set attributes
@@ -40,11 +55,47 @@ class BaseMusicClient():
         self.default_search_cookies = default_search_cookies or {}
         self.default_download_cookies = default_download_cookies or {}
         self.default_cookies = default_search_cookies
+        # content-addressed library shared across runs, disabled if library_dir is None
+        self.library_dir = library_dir
+        self.library = MusicLibrary.getinstance(library_dir=library_dir) if library_dir else None
+        # download speed cap (bytes/sec) shared by all clients in this process, None keeps the current cap
+        self.bandwidth_limiter = GLOBAL_BANDWIDTH_LIMITER
+        if bandwidth_limit is not None: self.bandwidth_limiter.setrate(bandwidth_limit)
+        # durable record of download jobs, used by resume after a crash, opened (and pruned) by the first download or resume, see _downloadqueue
+        self.enable_download_queue = enable_download_queue
+        self.download_queue_path = download_queue_path
+        self.download_queue, self.download_queue_lock = None, threading.Lock()
+        # receiver of progress events, a sink type name, a sink cfg dict or a BaseEventSink instance (rich on a terminal unless disable_print, otherwise nothing)
+        self.event_sink = event_sink
+        # idle download workers take over byte ranges of large range-capable files that are still running
+        self.enable_work_stealing = enable_work_stealing
+        self.min_steal_segment_size = min_steal_segment_size
+        # number of quality rungs resolved concurrently per search result, 1 walks the ladder one rung at a time
+        self.quality_ladder_top_k = quality_ladder_top_k
+        # when links are tested for sources whose api already returns size and format, 'always' (at search time), 'deferred' (at download time) or 
+        # 'sample' (a link_validation_sample_rate share at search time, the rest at download time)
+        assert link_validation in ['always', 'deferred', 'sample']
+        self.link_validation = link_validation
+        self.link_validation_sample_rate = link_validation_sample_rate
+        # third-party quality boost (only for sources implementing _boostquality), 'off', 'search' (alongside the native resolution of every result) 
+        # or 'download' (only for the results that are downloaded), calls are cut off after boost_timeout seconds and skipped while the breaker is open
+        assert boost_mode in ['off', 'search', 'download']
+        self.boost_mode = boost_mode
+        self.boost_timeout = boost_timeout
+        self.boost_circuit_breaker = CircuitBreaker(failure_threshold=boost_failure_threshold, recovery_timeout=boost_recovery_timeout)
+        # the boost pool is only started by the first boost, see _submitboost
+        self.boost_pool, self.boost_pool_lock = None, threading.Lock()
         # init requests.Session
         self.default_search_headers = {'User-Agent': UserAgent().random}
         self.default_download_headers = {'User-Agent': UserAgent().random}
         self.default_headers = self.default_search_headers
         self._initsession()
+        # pooled session shared by all link tests and probes of this client, so keep-alive connections to the same CDN are reused
+        self.audio_link_tester_session = AudioLinkTester.buildsession()
+        # pooled session of byte range / segment transfers, which are retried per segment by their callers instead of by get()
+        self.transfer_session = AudioLinkTester.buildsession()
+        # link test and probe results reused across searches, disabled if link_test_cache_ttl is not positive
+        self.link_test_cache = LinkTestCache(max_size=link_test_cache_size, ttl=link_test_cache_ttl, negative_ttl=min(60, link_test_cache_ttl)) if link_test_cache_ttl > 0 else None
         # proxied_session_client
         self.proxied_session_client = freeproxy.ProxiedSessionClient(
             proxy_sources=['QiyunipProxiedSession'] if proxy_sources is None else proxy_sources, 
@@ -54,6 +105,95 @@ class BaseMusicClient():
     def _initsession(self):
         self.session = requests.Session()
         self.session.headers = self.default_headers
+    '''_audiolinktester'''
+    def _audiolinktester(self):
+        return AudioLinkTester(
+            headers=self.default_download_headers, cookies=self.default_download_cookies, session=self.audio_link_tester_session, cache=self.link_test_cache,
+            volatile_params=self.volatile_url_params,
+        )
+    '''_validatelink'''
+    def _validatelink(self, download_url: str, request_overrides: dict = None):
+        return self._validatelinks([download_url], request_overrides)[0]
+    '''_validatelinks'''
+    def _validatelinks(self, download_urls: list, request_overrides: dict = None):
+        tested = [self.link_validation == 'always' or (self.link_validation == 'sample' and random.random() < self.link_validation_sample_rate) for _ in download_urls]
+        download_url_statuses = iter(self._audiolinktester().testmany([url for url, flag in zip(download_urls, tested) if flag], request_overrides))
+        return [
+            next(download_url_statuses) if flag else 
+            dict(ok=True, status=0, method="DEFERRED", final_url=None, ctype=None, clen=None, range=None, fmt=None, reason="Link test deferred to download time")
+            for flag in tested
+        ]
+    '''_boostquality'''
+    def _boostquality(self, song_id, request_overrides: dict = None):
+        return dict()
+    '''_submitboost'''
+    def _submitboost(self, boost_id, request_overrides: dict = None, stage: str = 'search'):
+        if self.boost_mode != stage or boost_id is None or not self.boost_circuit_breaker.allow(): return None
+        with self.boost_pool_lock:
+            if self.boost_pool is None: self.boost_pool = ThreadPoolExecutor(max_workers=8)
+        return self.boost_pool.submit(self._boostquality, boost_id, copy.deepcopy(request_overrides or {}))
+    '''_collectboosts'''
+    def _collectboosts(self, futures: list):
+        # all boosts of a batch share one deadline, so waiting for them never adds up to len(futures) * boost_timeout
+        submitted = [future for future in futures if future is not None]
+        if submitted: wait(submitted, timeout=self.boost_timeout)
+        return [self._collectboost(future, timeout=0) for future in futures]
+    '''_collectboost'''
+    def _collectboost(self, future, timeout: float = None):
+        if future is None: return dict()
+        # once the breaker has opened (e.g., after several timeouts in this batch) the remaining boosts are dropped without waiting for them
+        if not future.done() and self.boost_circuit_breaker.state == 'open':
+            future.cancel()
+            return dict()
+        try:
+            boost_result = future.result(timeout=self.boost_timeout if timeout is None else timeout)
+        except Exception as err:
+            future.cancel()
+            self.boost_circuit_breaker.recordfailure()
+            self.logger_handle.error(f'{self.source}._collectboost >>> (Error: {err or type(err).__name__})', disable_print=True)
+            return dict()
+        self.boost_circuit_breaker.recordsuccess()
+        return boost_result or dict()
+    '''_applyboost'''
+    def _applyboost(self, song_info: dict, boost_result: dict, boost_id=None):
+        # results boosted at download time remember the id passed to _boostquality, those without a working native link wait for that boost
+        if self.boost_mode == 'download' and boost_id is not None:
+            song_info['boost_id'] = boost_id
+            if not safeextractfromdict(song_info, ['download_url_status', 'ok'], False): song_info['boost_pending'] = True
+        if not boost_result or not boost_result.get('download_url') or not safeextractfromdict(boost_result, ['download_url_status', 'ok'], False): return song_info
+        # the boost wins if it is larger than the native file, or if the native link does not work
+        file_size_ori, file_size_imp = mb2byte(song_info.get('file_size')) or 0, int(float(boost_result.get('file_size') or 0) * 1024 * 1024)
+        if safeextractfromdict(song_info, ['download_url_status', 'ok'], False) and file_size_imp <= file_size_ori: return song_info
+        if isinstance(safeextractfromdict(song_info, ['raw_data', 'download_result'], None), dict): song_info['raw_data']['download_result']['boost_result'] = boost_result
+        song_info.update(dict(
+            download_url=boost_result['download_url'], ext=boost_result['ext'], file_size=f"{boost_result['file_size']} MB", download_url_status=boost_result['download_url_status'],
+        ))
+        return song_info
+    '''_keepboostable'''
+    def _keepboostable(self, download_url_status: dict, boost_result: dict):
+        # a result is kept if its native link or its boost works, or if it can still be rescued by the boost at download time
+        if (download_url_status or {}).get('ok', False) or safeextractfromdict(boost_result, ['download_url_status', 'ok'], False): return True
+        return self.boost_mode == 'download'
+    '''_boostsonginfos'''
+    def _boostsonginfos(self, song_infos: list, request_overrides: dict = None):
+        # boosts for the results that are about to be downloaded run concurrently, each result is boosted at most once,
+        # results that were only kept for their boost are dropped if it does not give them a working link
+        futures = [self._submitboost(song_info.pop('boost_id', None), request_overrides, stage='download') for song_info in song_infos]
+        boosted_song_infos = []
+        for song_info, boost_result in zip(song_infos, self._collectboosts(futures)):
+            boost_pending = song_info.pop('boost_pending', False)
+            self._applyboost(song_info, boost_result)
+            if boost_pending and not safeextractfromdict(song_info, ['download_url_status', 'ok'], False):
+                self.logger_handle.error(f'{self.source}._boostsonginfos >>> {song_info.get("song_name")} (Error: No working link after boosting)', disable_print=self.disable_print)
+                continue
+            boosted_song_infos.append(song_info)
+        return boosted_song_infos
+    '''_resolveladder'''
+    def _resolveladder(self, rungs: list, resolverung, isok=None, cancel_event=None):
+        return QualityLadderResolver(top_k=self.quality_ladder_top_k).resolve(rungs, resolverung, isok=isok, parent_cancel_event=cancel_event)
+    '''_raceresolvers'''
+    def _raceresolvers(self, resolvers: list, isok=None):
+        return QualityLadderResolver.race(resolvers, isok=isok)
     '''_constructsearchurls'''
     def _constructsearchurls(self, keyword: str, rule: dict = None, request_overrides: dict = None):
         raise NotImplementedError('not to be implemented')
@@ -63,6 +203,49 @@ class BaseMusicClient():
         work_dir = os.path.join(self.work_dir, self.source, f'{time_stamp} {keyword.replace(" ", "")}')
         touchdir(work_dir)
         return work_dir
+    '''_loadfromlibrary'''
+    def _loadfromlibrary(self, identifier):
+        if self.library is None: return None
+        record = self.library.lookup(self.source, identifier)
+        if record is None or not record['song_info']: return None
+        song_info = copy.deepcopy(record['song_info'])
+        song_info.pop('save_path', None)
+        song_info['library_path'], song_info['content_hash'] = record['save_path'], record['content_hash']
+        return song_info
+    '''_savetolibrary'''
+    def _savetolibrary(self, song_info: dict, save_path: str, content_hash: str = None):
+        if self.library is None: return
+        try:
+            content_hash = content_hash or MusicLibrary.hashfile(save_path)
+            song_info = {k: v for k, v in song_info.items() if k not in ['library_path', 'work_dir']}
+            self.library.add(self.source, song_info['identifier'], content_hash, save_path, song_info)
+        except Exception as err:
+            self.logger_handle.error(f'{self.source}._savetolibrary >>> {save_path} (Error: {err})', disable_print=self.disable_print)
+    '''_linkfromlibrary'''
+    def _linkfromlibrary(self, song_info: dict, save_path: str):
+        library_path = song_info.get('library_path')
+        if not library_path or not os.path.exists(library_path): return False
+        MusicLibrary.linkto(library_path, save_path)
+        return True
+    '''_constructsavepath'''
+    def _constructsavepath(self, song_info: dict, ext: str = None):
+        ext = ext or f".{song_info['ext']}"
+        save_path, same_name_file_idx = os.path.join(song_info['work_dir'], f"{song_info['song_name']}{ext}"), 1
+        while os.path.exists(save_path):
+            save_path = os.path.join(song_info['work_dir'], f"{song_info['song_name']}_{same_name_file_idx}{ext}")
+            same_name_file_idx += 1
+        return save_path
+    '''_buildeventsink'''
+    def _buildeventsink(self, mode: str):
+        event_sink = self.event_sink
+        if isinstance(event_sink, BaseEventSink): return event_sink
+        # library callers that silenced the logs get no live display either unless they ask for one
+        if event_sink is None: event_sink = 'RichEventSink' if (sys.stdout.isatty() and not self.disable_print) else 'NullEventSink'
+        # not built through BuildEventSink, which deep-copies its config, so a caller-owned stream is written to by reference
+        event_sink_cfg = {'type': event_sink} if isinstance(event_sink, str) else copy.copy(event_sink)
+        event_sink_cfg['mode'] = mode
+        event_sink_type = event_sink_cfg.pop('type')
+        return EventSinkBuilder.REGISTERED_MODULES[event_sink_type](**event_sink_cfg)
     '''_removeduplicates'''
     def _removeduplicates(self, song_infos: list = None):
         unique_song_infos, identifiers = [], set()
@@ -74,8 +257,27 @@ class BaseMusicClient():
         return unique_song_infos
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         raise NotImplementedError('not be implemented')
+    '''_fetchsearchpage'''
+    def _fetchsearchpage(self, search_url, cursor=None, request_overrides: dict = None):
+        # returns (search_url with the cursor applied, parsed page payload, cursor of the next page or None)
+        raise NotImplementedError('not to be implemented')
+    '''_itersearchpages'''
+    def _itersearchpages(self, search_urls: list, request_overrides: dict = None):
+        # yields (search_url, search_payload), for cursor sources every page is fetched exactly once and its response yields the cursor of the next one
+        if not self.cursor_paging:
+            for search_url in search_urls: yield search_url, None
+            return
+        cursor = None
+        for page_idx, search_url in enumerate(search_urls):
+            if page_idx > 0 and not cursor: return
+            try:
+                search_url, search_payload, cursor = self._fetchsearchpage(search_url, cursor, request_overrides)
+            except Exception as err:
+                self.logger_handle.error(f'{self.source}._itersearchpages >>> {search_url} (Error: {err})', disable_print=self.disable_print)
+                return
+            yield search_url, search_payload
     '''search'''
     @usesearchheaderscookies
     def search(self, keyword: str, num_threadings=5, request_overrides: dict = None, rule: dict = None):
@@ -86,21 +288,24 @@ class BaseMusicClient():
         # construct search urls
         search_urls = self._constructsearchurls(keyword=keyword, rule=rule, request_overrides=request_overrides)
         # multi threadings for searching music files
-        with Progress(TextColumn("{task.description}"), BarColumn(bar_width=None), MofNCompleteColumn(), TimeRemainingColumn()) as progress:
+        with self._buildeventsink(mode='search') as progress:
             progress_id = progress.add_task(f"{self.source}.search >>> completed (0/{len(search_urls)})", total=len(search_urls))
             song_infos, submitted_tasks = [], []
             with ThreadPoolExecutor(max_workers=num_threadings) as pool:
-                for search_url in search_urls:
+                # cursor pages are fetched one after another here while the items of the pages already fetched are resolved in the pool
+                for search_url, search_payload in self._itersearchpages(search_urls, request_overrides):
+                    search_kwargs = {'search_payload': search_payload} if self.cursor_paging else {}
                     submitted_tasks.append(pool.submit(
-                        self._search, keyword, search_url, request_overrides, song_infos, progress, progress_id
+                        self._search, keyword, search_url, request_overrides, song_infos, progress, progress_id, **search_kwargs
                     ))
                 for _ in as_completed(submitted_tasks):
-                    num_searched_urls = int(progress.tasks[progress_id].completed)
+                    num_searched_urls = int(progress.getcompleted(progress_id))
                     progress.update(progress_id, description=f"{self.source}.search >>> completed ({num_searched_urls}/{len(search_urls)})")
-        song_infos = self._removeduplicates(song_infos=song_infos)
-        work_dir = self._constructuniqueworkdir(keyword=keyword)
-        for song_info in song_infos:
-            song_info['work_dir'] = work_dir
+            song_infos = self._removeduplicates(song_infos=song_infos)
+            work_dir = self._constructuniqueworkdir(keyword=keyword)
+            for song_info in song_infos:
+                song_info['work_dir'] = work_dir
+                progress.resultfound(self.source, song_info)
         # logging
         if len(song_infos) > 0:
             work_dir = song_infos[0]['work_dir']
@@ -113,35 +318,195 @@ class BaseMusicClient():
         return song_infos
     '''_download'''
     @usedownloadheaderscookies
-    def _download(self, song_info: dict, request_overrides: dict = None, downloaded_song_infos: list = [], progress: Progress = None, 
+    def _download(self, song_info: dict, request_overrides: dict = None, downloaded_song_infos: list = [], progress: BaseEventSink = None, 
                   song_progress_id: int = 0, songs_progress_id: int = 0):
         request_overrides = request_overrides or {}
         try:
             touchdir(song_info['work_dir'])
+            # already in the library, reference it instead of downloading again
+            if song_info.get('library_path') and os.path.exists(song_info['library_path']):
+                save_path = self._constructsavepath(song_info=song_info, ext=os.path.splitext(song_info['library_path'])[-1])
+                self._linkfromlibrary(song_info, save_path)
+                progress.update(song_progress_id, total=1, completed=1)
+                progress.advance(songs_progress_id, 1)
+                downloaded_song_info = copy.deepcopy(song_info)
+                downloaded_song_info['save_path'] = save_path
+                downloaded_song_infos.append(downloaded_song_info)
+                progress.jobdone(song_progress_id, downloaded_song_info, description=f"{self.source}.download >>> {song_info['song_name']} (Success: From Library)")
+                return downloaded_song_infos
+            # links whose test was deferred at search time are validated before any bytes are written
+            if safeextractfromdict(song_info, ['download_url_status', 'method'], None) == 'DEFERRED':
+                download_url_status = self._audiolinktester().test(song_info['download_url'], request_overrides)
+                if not download_url_status['ok']: raise RuntimeError(download_url_status['reason'])
+                song_info['download_url_status'] = download_url_status
             with self.get(song_info['download_url'], stream=True, **request_overrides) as resp:
                 resp.raise_for_status()
                 total_size, chunk_size, downloaded_size = int(resp.headers['content-length']), song_info.get('chunk_size', 1024), 0
                 progress.update(song_progress_id, total=total_size)
-                save_path, same_name_file_idx = os.path.join(song_info['work_dir'], f"{song_info['song_name']}.{song_info['ext']}"), 1
-                while os.path.exists(save_path):
-                    save_path = os.path.join(song_info['work_dir'], f"{song_info['song_name']}_{same_name_file_idx}.{song_info['ext']}")
-                    same_name_file_idx += 1
-                with open(save_path, "wb") as fp:
-                    for chunk in resp.iter_content(chunk_size=chunk_size):
-                        if not chunk: continue
-                        fp.write(chunk)
-                        downloaded_size = downloaded_size + len(chunk)
-                        downloading_text = "%0.2fMB/%0.2fMB" % (downloaded_size / 1024 / 1024, total_size / 1024 / 1024)
-                        progress.advance(song_progress_id, len(chunk))
-                        progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Downloading: {downloading_text})")
+                # bytes go to a .part file that only replaces save_path once complete, so a crash never leaves a truncated file under the final name
+                save_path = self._constructsavepath(song_info=song_info)
+                part_path, hasher, transfer = f'{save_path}.part', hashlib.sha256() if self.library is not None else None, None
+                try:
+                    with open(part_path, "wb") as fp:
+                        transfer = self._registerstealabletransfer(song_info, resp, total_size, part_path, fp, request_overrides, progress, song_progress_id)
+                        for chunk in resp.iter_content(chunk_size=chunk_size):
+                            if not chunk: continue
+                            if transfer is not None: chunk = chunk[:transfer.claim(len(chunk))]
+                            self.bandwidth_limiter.consume(len(chunk))
+                            fp.write(chunk)
+                            if hasher is not None: hasher.update(chunk)
+                            downloaded_size = downloaded_size + len(chunk)
+                            downloading_text = "%0.2fMB/%0.2fMB" % (downloaded_size / 1024 / 1024, total_size / 1024 / 1024)
+                            progress.bytestransferred(song_progress_id, len(chunk))
+                            progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Downloading: {downloading_text})")
+                            if transfer is not None and transfer.remaining() <= 0: break
+                    # byte ranges taken over by idle workers are written in place, so the digest is computed from the assembled file
+                    if transfer is not None and transfer.wait() > 0: hasher = None
+                    missing_size = transfer.remaining() if transfer is not None else total_size - downloaded_size
+                    if missing_size > 0: raise RuntimeError(f'incomplete download ({total_size - missing_size}/{total_size} bytes)')
+                    os.replace(part_path, save_path)
+                finally:
+                    if transfer is not None: WorkStealingScheduler.current().unregister(transfer)
+                    if os.path.exists(part_path): os.remove(part_path)
                 progress.advance(songs_progress_id, 1)
-                progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Success)")
                 downloaded_song_info = copy.deepcopy(song_info)
                 downloaded_song_info['save_path'] = save_path
                 downloaded_song_infos.append(downloaded_song_info)
+                self._savetolibrary(downloaded_song_info, save_path, hasher.hexdigest() if hasher is not None else None)
+                progress.jobdone(song_progress_id, downloaded_song_info, description=f"{self.source}.download >>> {song_info['song_name']} (Success)")
         except Exception as err:
-            progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Error: {err})")
+            progress.error(song_progress_id, f"{self.source}.download >>> {song_info['song_name']} (Error: {err})")
+        return downloaded_song_infos
+    '''_transferget'''
+    def _transferget(self, url, **kwargs):
+        # a single attempt on the pooled transfer session with the download headers and cookies, the status code is left to the caller
+        kwargs = copy.deepcopy(kwargs)
+        kwargs['headers'] = {**(self.default_download_headers or {}), **(kwargs.get('headers') or {})}
+        if 'cookies' not in kwargs: kwargs['cookies'] = self.default_download_cookies
+        if 'timeout' not in kwargs: kwargs['timeout'] = (10, 60)
+        return self.transfer_session.get(url, **kwargs)
+    '''_registerstealabletransfer'''
+    def _registerstealabletransfer(self, song_info: dict, resp: requests.Response, total_size: int, save_path: str, fp, request_overrides: dict, progress: BaseEventSink,
+                                   song_progress_id: int):
+        scheduler = WorkStealingScheduler.current()
+        if scheduler is None or not self.enable_work_stealing or total_size < 2 * self.min_steal_segment_size: return None
+        if resp.headers.get('accept-ranges', '').lower() != 'bytes' or resp.headers.get('content-encoding', 'identity').lower() != 'identity': return None
+        download_url, chunk_size = resp.url, song_info.get('chunk_size', 1024)
+        def _fetchsegment(start: int, end: int):
+            segment_request_overrides = copy.deepcopy(request_overrides)
+            segment_request_overrides['headers'] = {**(segment_request_overrides.get('headers') or {}), 'Range': f'bytes={start}-{end - 1}'}
+            with self._transferget(download_url, stream=True, **segment_request_overrides) as segment_resp:
+                if segment_resp.status_code != 206: raise RuntimeError(f'range request not honored for {download_url} (status {segment_resp.status_code})')
+                content_range = segment_resp.headers.get('content-range', '')
+                match = re.match(r'bytes\s+(\d+)-(\d+)/', content_range)
+                if match is None or (int(match.group(1)), int(match.group(2))) != (start, end - 1):
+                    raise RuntimeError(f'unexpected Content-Range "{content_range}" for bytes {start}-{end - 1} of {download_url}')
+                with open(save_path, 'r+b') as fp:
+                    fp.seek(start)
+                    position = start
+                    for chunk in segment_resp.iter_content(chunk_size=chunk_size):
+                        chunk = chunk[:end - position]
+                        if not chunk: break
+                        self.bandwidth_limiter.consume(len(chunk))
+                        fp.write(chunk)
+                        position += len(chunk)
+                        progress.bytestransferred(song_progress_id, len(chunk))
+                assert position == end, f'incomplete segment {start}-{end - 1} of {download_url}'
+        # the file exists at its full size before any thief can open it
+        fp.truncate(total_size)
+        fp.flush()
+        transfer = StealableTransfer(total_size=total_size, fetchsegment=_fetchsegment, min_segment_size=self.min_steal_segment_size)
+        scheduler.register(transfer)
+        return transfer
+    '''_sortbyfilesize'''
+    def _sortbyfilesize(self, song_infos: list):
+        # largest first minimizes the makespan of the pool, files of unknown size go last
+        def _key(song_info):
+            file_size = mb2byte(song_info.get('file_size'))
+            return (file_size is None, -(file_size or 0))
+        return sorted(song_infos, key=_key)
+    '''_downloadqueue'''
+    def _downloadqueue(self):
+        if not self.enable_download_queue: return None
+        with self.download_queue_lock:
+            if self.download_queue is None: self.download_queue = DownloadQueue(db_path=self.download_queue_path)
+            return self.download_queue
+    '''_enqueuedownloadjob'''
+    def _enqueuedownloadjob(self, song_info: dict):
+        if not self.enable_download_queue: return None
+        if song_info.get('download_job_id') is not None: return song_info['download_job_id']
+        try:
+            return self._downloadqueue().enqueue(self.source, song_info)
+        except Exception as err:
+            self.logger_handle.error(f'{self.source}._enqueuedownloadjob >>> {song_info.get("song_name")} (Error: {err})', disable_print=self.disable_print)
+            return None
+    '''_transitiondownloadjob'''
+    def _transitiondownloadjob(self, job_id: int, state: str, **kwargs):
+        if not self.enable_download_queue or job_id is None: return
+        try:
+            self._downloadqueue().transition(job_id, state, **kwargs)
+        except Exception as err:
+            self.logger_handle.error(f'{self.source}._transitiondownloadjob >>> {job_id} (Error: {err})', disable_print=self.disable_print)
+    '''_downloadjob'''
+    def _downloadjob(self, job_id: int, song_info: dict, request_overrides: dict = None, downloaded_song_infos: list = [], progress: BaseEventSink = None,
+                     song_progress_id: int = 0, songs_progress_id: int = 0):
+        self._transitiondownloadjob(job_id, 'downloading')
+        job_downloaded_song_infos = self._download(song_info, request_overrides, [], progress, song_progress_id, songs_progress_id)
+        if job_downloaded_song_infos:
+            downloaded_song_infos.extend(job_downloaded_song_infos)
+            self._transitiondownloadjob(job_id, 'done', save_path=job_downloaded_song_infos[-1]['save_path'])
+        else:
+            self._transitiondownloadjob(job_id, 'failed', error='Download did not complete')
         return downloaded_song_infos
+    '''_reresolve'''
+    def _reresolve(self, song_info: dict, request_overrides: dict = None):
+        request_overrides = request_overrides or {}
+        # links that still work are kept as is
+        download_url = song_info.get('download_url')
+        if download_url and not isinstance(download_url, str): download_url = (getattr(download_url, 'urls', None) or [None])[0]
+        if song_info.get('library_path') and os.path.exists(song_info['library_path']): return song_info
+        if download_url and self._audiolinktester().test(download_url, request_overrides)['ok']:
+            return song_info
+        # expired links are resolved again by searching the song and matching its identifier
+        keyword = ' '.join([item for item in [song_info.get('song_name'), song_info.get('singers')] if item and item != 'NULL'])
+        song_infos = []
+        with NullEventSink(mode='search') as progress:
+            search_urls = self._constructsearchurls(keyword=keyword, rule={}, request_overrides=request_overrides)
+            progress_id = progress.add_task(f"{self.source}._reresolve", total=len(search_urls))
+            for search_url, search_payload in self._itersearchpages(search_urls, request_overrides):
+                search_kwargs = {'search_payload': search_payload} if self.cursor_paging else {}
+                self._search(keyword, search_url, request_overrides, song_infos, progress, progress_id, **search_kwargs)
+                matched = [item for item in song_infos if str(item['identifier']) == str(song_info['identifier'])]
+                if not matched: continue
+                resolved_song_info = copy.deepcopy(matched[0])
+                resolved_song_info['work_dir'] = song_info['work_dir']
+                return resolved_song_info
+        return None
+    '''resume'''
+    def resume(self, num_threadings=5, request_overrides: dict = None, include_failed: bool = False):
+        # init
+        request_overrides = request_overrides or {}
+        if not self.enable_download_queue: return []
+        jobs = self._downloadqueue().unfinished(source=self.source, include_failed=include_failed)
+        self.logger_handle.info(f'Start to resume {len(jobs)} unfinished download jobs using {self.source}.', disable_print=self.disable_print)
+        # re-resolve expired download urls
+        song_infos = []
+        for job in jobs:
+            self._transitiondownloadjob(job['job_id'], 'resolving')
+            try:
+                song_info = self._reresolve(job['song_info'], request_overrides=request_overrides)
+            except Exception as err:
+                song_info = None
+                self.logger_handle.error(f'{self.source}.resume >>> {job["song_info"].get("song_name")} (Error: {err})', disable_print=self.disable_print)
+            if song_info is None:
+                self._transitiondownloadjob(job['job_id'], 'failed', error='Failed to re-resolve the download url')
+                continue
+            song_info['download_job_id'] = job['job_id']
+            self._transitiondownloadjob(job['job_id'], 'queued', song_info=song_info)
+            song_infos.append(song_info)
+        # download
+        if not song_infos: return []
+        return self.download(song_infos=song_infos, num_threadings=num_threadings, request_overrides=request_overrides)
     '''download'''
     @usedownloadheaderscookies
     def download(self, song_infos: list, num_threadings=5, request_overrides: dict = None):
@@ -149,26 +514,58 @@ class BaseMusicClient():
         request_overrides = request_overrides or {}
         # logging
         self.logger_handle.info(f'Start to download music files using {self.source}.', disable_print=self.disable_print)
+        # third-party quality boost of the selected results
+        if self.boost_mode == 'download': song_infos = self._boostsonginfos(song_infos, request_overrides)
         # multi threadings for downloading music files
-        columns = [
-            SpinnerColumn(), TextColumn("{task.description}"), BarColumn(bar_width=None), TaskProgressColumn(),
-            DownloadColumn(), TransferSpeedColumn(), TimeRemainingColumn(),
-        ]
-        with Progress(*columns, refresh_per_second=20, expand=True) as progress:
+        with self._buildeventsink(mode='download') as progress:
             songs_progress_id = progress.add_task(f"{self.source}.download >>> completed (0/{len(song_infos)})", total=len(song_infos))
-            song_progress_ids, downloaded_song_infos, submitted_tasks = [], [], []
+            song_progress_ids, downloaded_song_infos = [], []
             for _, song_info in enumerate(song_infos):
                 desc = f"{self.source}.download >>> {song_info['song_name']} (Preparing)"
                 song_progress_ids.append(progress.add_task(desc, total=None))
-            with ThreadPoolExecutor(max_workers=num_threadings) as pool:
-                for song_progress_id, song_info in zip(song_progress_ids, song_infos):
-                    submitted_tasks.append(pool.submit(
-                        self._download, song_info, request_overrides, downloaded_song_infos, progress, song_progress_id, songs_progress_id
-                    ))
-                for _ in as_completed(submitted_tasks):
-                    num_downloaded_songs = int(progress.tasks[songs_progress_id].completed)
-                    progress.update(songs_progress_id, description=f"{self.source}.download >>> completed ({num_downloaded_songs}/{len(song_infos)})")
+            job_ids = [self._enqueuedownloadjob(song_info) for song_info in song_infos]
+            jobs = self._sortbyfilesize([
+                dict(job_id=job_id, song_info=song_info, song_progress_id=song_progress_id, file_size=song_info.get('file_size'))
+                for song_progress_id, song_info, job_id in zip(song_progress_ids, song_infos, job_ids)
+            ])
+            def _runjob(job):
+                self._downloadjob(job['job_id'], job['song_info'], request_overrides, downloaded_song_infos, progress, job['song_progress_id'], songs_progress_id)
+                num_downloaded_songs = int(progress.getcompleted(songs_progress_id))
+                progress.update(songs_progress_id, description=f"{self.source}.download >>> completed ({num_downloaded_songs}/{len(song_infos)})")
+            WorkStealingScheduler(num_workers=num_threadings, enable_stealing=self.enable_work_stealing).run(jobs, _runjob)
         # logging
+        self._savedownloadresults(downloaded_song_infos)
+        # return
+        return downloaded_song_infos
+    '''downloadpages'''
+    @usedownloadheaderscookies
+    def downloadpages(self, pages, num_threadings=5, request_overrides: dict = None):
+        # init
+        request_overrides = request_overrides or {}
+        # logging
+        self.logger_handle.info(f'Start to download music files using {self.source}.', disable_print=self.disable_print)
+        # pages (lists of song_infos) are consumed while the songs of earlier pages download, all of them feed one running scheduler
+        with self._buildeventsink(mode='download') as progress:
+            songs_progress_id, downloaded_song_infos, num_songs = progress.add_task(f"{self.source}.download >>> completed (0/0)", total=0), [], [0]
+            def _iterjobs():
+                for page_song_infos in pages:
+                    if self.boost_mode == 'download': page_song_infos = self._boostsonginfos(page_song_infos, request_overrides)
+                    num_songs[0] += len(page_song_infos)
+                    progress.update(songs_progress_id, total=num_songs[0])
+                    for song_info in page_song_infos:
+                        song_progress_id = progress.add_task(f"{self.source}.download >>> {song_info['song_name']} (Preparing)", total=None)
+                        yield dict(job_id=self._enqueuedownloadjob(song_info), song_info=song_info, song_progress_id=song_progress_id, file_size=song_info.get('file_size'))
+            def _runjob(job):
+                self._downloadjob(job['job_id'], job['song_info'], request_overrides, downloaded_song_infos, progress, job['song_progress_id'], songs_progress_id)
+                num_downloaded_songs = int(progress.getcompleted(songs_progress_id))
+                progress.update(songs_progress_id, description=f"{self.source}.download >>> completed ({num_downloaded_songs}/{num_songs[0]})")
+            WorkStealingScheduler(num_workers=num_threadings, enable_stealing=self.enable_work_stealing).run(_iterjobs(), _runjob)
+        # logging
+        self._savedownloadresults(downloaded_song_infos)
+        # return
+        return downloaded_song_infos
+    '''_savedownloadresults'''
+    def _savedownloadresults(self, downloaded_song_infos: list):
         if len(downloaded_song_infos) > 0:
             work_dir = downloaded_song_infos[0]['work_dir']
             touchdir(work_dir)
@@ -176,8 +573,6 @@ class BaseMusicClient():
         else:
             work_dir = self.work_dir
         self.logger_handle.info(f'Finished downloading music files using {self.source}. Download results have been saved to {work_dir}, valid downloads: {len(downloaded_song_infos)}.', disable_print=self.disable_print)
-        # return
-        return downloaded_song_infos
     '''get'''
     def get(self, url, **kwargs):
         if 'cookies' not in kwargs: kwargs['cookies'] = self.default_cookies
@@ -226,6 +621,24 @@ class BaseMusicClient():
             if resp.status_code != 200: continue
             return resp
         return resp
+    '''close'''
+    def close(self):
+        # releases the boost pool, the pooled sessions and the download queue, the client can still be used afterwards (they are recreated on demand)
+        with self.boost_pool_lock:
+            if self.boost_pool is not None: self.boost_pool.shutdown(wait=False, cancel_futures=True)
+            self.boost_pool = None
+        for session in [self.session, self.audio_link_tester_session, self.transfer_session]:
+            try: session.close()
+            except Exception: pass
+        with self.download_queue_lock:
+            if self.download_queue is not None: self.download_queue.close()
+            self.download_queue = None
+    '''__enter__'''
+    def __enter__(self):
+        return self
+    '''__exit__'''
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     '''_savetopkl'''
     def _savetopkl(self, data, file_path, auto_sanitize=True):
         if auto_sanitize: file_path = sanitize_filepath(file_path)
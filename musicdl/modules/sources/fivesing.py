@@ -9,8 +9,7 @@ WeChat Official Account (微信公众号):
 import copy
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import legalizestring, byte2mb, resp2json, isvalidresp, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, QualityLadderResolver, legalizestring, byte2mb, resp2json, isvalidresp, usesearchheaderscookies
 
 
 '''FiveSingMusicClient'''
@@ -45,7 +44,7 @@ class FiveSingMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -58,21 +57,27 @@ class FiveSingMusicClient(BaseMusicClient):
                 # --download results
                 if 'songId' not in search_result or 'typeEname' not in search_result:
                     continue
+                library_song_info = self._loadfromlibrary(search_result['songId'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 params = {'songid': str(search_result['songId']), 'songtype': search_result['typeEname']}
                 resp = self.get('http://mobileapi.5sing.kugou.com/song/getSongUrl', params=params, **request_overrides)
                 if (not isvalidresp(resp)) or (resp2json(resp)['code'] not in [1000]):
                     continue
                 download_result: dict = resp2json(resp)
-                for quality in ['sq', 'hq', 'lq']:
-                    data: dict = download_result.get('data', {})
+                data: dict = download_result.get('data', {})
+                # _resolvequality
+                def _resolvequality(quality, cancel_event):
                     download_url = data.get(f'{quality}url', '').strip() or data.get(f'{quality}url_backup', '').strip()
-                    if not download_url: continue
+                    if not download_url: return None
                     ext = data.get(f'{quality}ext', 'mp3').strip() or 'mp3'
                     file_size = byte2mb(data.get(f'{quality}size', '0'))
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                    if download_url_status['ok']: break
-                if not download_url: continue
-                if not download_url_status['ok']: continue
+                    download_url_status = self._validatelink(download_url, request_overrides)
+                    return dict(ok=download_url_status['ok'], download_url=download_url, ext=ext, file_size=file_size, download_url_status=download_url_status)
+                _, resolved = self._resolveladder(['sq', 'hq', 'lq'], _resolvequality)
+                if not QualityLadderResolver.isok(resolved): continue
+                download_url, ext, file_size, download_url_status = resolved['download_url'], resolved['ext'], resolved['file_size'], resolved['download_url_status']
                 # --lyric results
                 params = {'songid': str(search_result['songId']), 'songtype': search_result['typeEname'], 'songfields': '', 'userfields': ''}
                 resp = self.get('http://mobileapi.5sing.kugou.com/song/newget', params=params, **request_overrides)
@@ -100,6 +105,6 @@ class FiveSingMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
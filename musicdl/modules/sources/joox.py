@@ -11,13 +11,13 @@ import base64
 import json_repair
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, QualityLadderResolver, legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies
 
 
 '''JooxMusicClient'''
 class JooxMusicClient(BaseMusicClient):
     source = 'JooxMusicClient'
+    volatile_url_params = ('guid', 'vkey', 'uin', 'fromtag')
     def __init__(self, **kwargs):
         super(JooxMusicClient, self).__init__(**kwargs)
         self.default_search_headers = {
@@ -48,7 +48,7 @@ class JooxMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -64,21 +64,26 @@ class JooxMusicClient(BaseMusicClient):
                 # --download results
                 if 'song_info' not in search_result or 'id' not in search_result['song_info']:
                     continue
+                library_song_info = self._loadfromlibrary(search_result['song_info']['id'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 params = {'songid': search_result['song_info']['id'], 'lang': 'zh_cn', 'country': 'sg'}
                 resp = self.get('https://api.joox.com/web-fcgi-bin/web_get_songinfo', params=params, **request_overrides)
                 download_result = json_repair.loads(resp.text.replace('MusicInfoCallback(', '')[:-1])
                 kbps_map = json_repair.loads(download_result['kbps_map'])
-                for quality in [('r320Url', '320'), ('r192Url', '192'), ('mp3Url', '128'), ('m4aUrl', '96')]:
-                    if (not kbps_map.get(quality[1])) or (not download_result.get(quality[0])):
-                        continue
+                duration = seconds2hms(download_result.get('minterval', '0'))
+                # _resolvequality
+                def _resolvequality(quality, cancel_event):
+                    if (not kbps_map.get(quality[1])) or (not download_result.get(quality[0])): return None
                     download_url: str = download_result.get(quality[0])
                     file_size = byte2mb(kbps_map.get(quality[1], '0'))
                     ext = download_url.split('.')[-1].split('?')[0]
-                    duration = seconds2hms(download_result.get('minterval', '0'))
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                    if download_url_status['ok']: break
-                if not download_url: continue
-                if not download_url_status['ok']: continue
+                    download_url_status = self._audiolinktester().test(download_url, request_overrides)
+                    return dict(ok=download_url_status['ok'], download_url=download_url, ext=ext, file_size=file_size, download_url_status=download_url_status)
+                _, resolved = self._resolveladder([('r320Url', '320'), ('r192Url', '192'), ('mp3Url', '128'), ('m4aUrl', '96')], _resolvequality)
+                if not QualityLadderResolver.isok(resolved): continue
+                download_url, ext, file_size, download_url_status = resolved['download_url'], resolved['ext'], resolved['file_size'], resolved['download_url_status']
                 # --lyric results
                 params = {'musicid': search_result['song_info']['id'], 'country': 'sg', 'lang': 'zh_cn'}
                 resp = self.get('https://api.joox.com/web-fcgi-bin/web_lyric', params=params, **request_overrides)
@@ -106,6 +111,6 @@ class JooxMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
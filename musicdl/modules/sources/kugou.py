@@ -8,10 +8,11 @@ WeChat Official Account (微信公众号):
 '''
 import copy
 import base64
+import threading
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies, AudioLinkTester
+from concurrent.futures import ThreadPoolExecutor
+from ..utils import BaseEventSink, LyricCache, legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies
 
 
 '''KugouMusicClient'''
@@ -27,6 +28,43 @@ class KugouMusicClient(BaseMusicClient):
         }
         self.default_headers = self.default_search_headers
         self._initsession()
+        # lyrics are keyed by FileHash, so repeated searches never download the lyric of the same file twice, the cache is opened by the first lyric lookup
+        self.lyric_cache, self.lyric_cache_lock = None, threading.Lock()
+    '''_lyriccache'''
+    def _lyriccache(self):
+        with self.lyric_cache_lock:
+            if self.lyric_cache is None: self.lyric_cache = LyricCache()
+            return self.lyric_cache
+    '''close'''
+    def close(self):
+        super(KugouMusicClient, self).close()
+        with self.lyric_cache_lock:
+            if self.lyric_cache is not None: self.lyric_cache.close()
+            self.lyric_cache = None
+    '''_fetchdownloadresult'''
+    def _fetchdownloadresult(self, file_hash: str, request_overrides: dict = None):
+        request_overrides = request_overrides or {}
+        resp = self.get(f"http://m.kugou.com/app/i/getSongInfo.php?cmd=playInfo&hash={file_hash}", **request_overrides)
+        if not isvalidresp(resp): return None
+        return resp2json(resp)
+    '''_fetchlyric'''
+    def _fetchlyric(self, search_result: dict, request_overrides: dict = None):
+        request_overrides = request_overrides or {}
+        cached = self._lyriccache().get(self.source, search_result['FileHash'])
+        if cached is not None: return cached
+        params = {'keyword': search_result.get('FileName', ''), 'duration': search_result.get('Duration', '99999'), 'hash': search_result['FileHash']}
+        resp = self.get('http://lyrics.kugou.com/search', params=params, **request_overrides)
+        if not isvalidresp(resp): return dict(), 'NULL'
+        lyric_result, lyric = resp2json(resp), 'NULL'
+        try:
+            id = lyric_result['candidates'][0]['id']
+            accesskey = lyric_result['candidates'][0]['accesskey']
+            resp = self.get(f'http://lyrics.kugou.com/download?ver=1&client=pc&id={id}&accesskey={accesskey}&fmt=lrc&charset=utf8', **request_overrides)
+            lyric = base64.b64decode(resp2json(resp)['content']).decode('utf-8')
+        except:
+            lyric = 'NULL'
+        if lyric != 'NULL': self._lyriccache().set(self.source, search_result['FileHash'], lyric_result, lyric)
+        return lyric_result, lyric
     '''_constructsearchurls'''
     def _constructsearchurls(self, keyword: str, rule: dict = None, request_overrides: dict = None):
         # init
@@ -46,7 +84,7 @@ class KugouMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -55,34 +93,35 @@ class KugouMusicClient(BaseMusicClient):
             resp = self.get(search_url, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)['data']['lists']
+            candidates = []
             for search_result in search_results:
-                # --download results
                 if 'FileHash' not in search_result:
                     continue
-                resp = self.get(f"http://m.kugou.com/app/i/getSongInfo.php?cmd=playInfo&hash={search_result['FileHash']}", **request_overrides)
-                if not isvalidresp(resp): continue
-                download_result: dict = resp2json(resp)
-                download_url = download_result.get('url') or download_result.get('backup_url')
+                library_song_info = self._loadfromlibrary(search_result['FileHash'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
+                candidates.append(search_result)
+            # --song infos and lyrics of all items are fetched concurrently
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                download_futures = [pool.submit(self._fetchdownloadresult, search_result['FileHash'], request_overrides) for search_result in candidates]
+                lyric_futures = [pool.submit(self._fetchlyric, search_result, request_overrides) for search_result in candidates]
+                download_results = [future.result() for future in download_futures]
+                lyric_results = [future.result() for future in lyric_futures]
+            # --download urls of the whole page are validated at once
+            download_urls = []
+            for download_result in download_results:
+                download_url = (download_result.get('url') or download_result.get('backup_url')) if download_result else None
+                if isinstance(download_url, list): download_url = download_url[0] if download_url else None
+                download_urls.append(download_url)
+            download_url_statuses = iter(self._validatelinks([download_url for download_url in download_urls if download_url], request_overrides))
+            for search_result, download_result, download_url, (lyric_result, lyric) in zip(candidates, download_results, download_urls, lyric_results):
+                # --download results
                 if not download_url: continue
-                if isinstance(download_url, list): download_url = download_url[0]
-                download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
+                download_url_status = next(download_url_statuses)
                 if not download_url_status['ok']: continue
                 file_size = byte2mb(download_result.get('fileSize', '0'))
                 duration = seconds2hms(download_result.get('timeLength', '0'))
-                # --lyric results
-                params = {'keyword': search_result.get('FileName', ''), 'duration': search_result.get('Duration', '99999'), 'hash': search_result['FileHash']}
-                resp = self.get('http://lyrics.kugou.com/search', params=params, **request_overrides)
-                if isvalidresp(resp):
-                    lyric_result, lyric = resp2json(resp), 'NULL'
-                    try:
-                        id = lyric_result['candidates'][0]['id']
-                        accesskey = lyric_result['candidates'][0]['accesskey']
-                        lyric = self.get(f'http://lyrics.kugou.com/download?ver=1&client=pc&id={id}&accesskey={accesskey}&fmt=lrc&charset=utf8').json()['content']
-                        lyric = base64.b64decode(lyric).decode('utf-8')
-                    except:
-                        lyric = 'NULL'
-                else:
-                    lyric_result, lyric = dict(), 'NULL'
                 # --construct song_info
                 song_info = dict(
                     source=self.source, raw_data=dict(search_result=search_result, download_result=download_result, lyric_result=lyric_result), 
@@ -99,6 +138,6 @@ class KugouMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
@@ -9,8 +9,7 @@ WeChat Official Account (微信公众号):
 import copy
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import legalizestring, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, AudioLinkTester, legalizestring, resp2json, isvalidresp, seconds2hms, usesearchheaderscookies
 
 
 '''KuwoMusicClient'''
@@ -49,7 +48,7 @@ class KuwoMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -58,22 +57,28 @@ class KuwoMusicClient(BaseMusicClient):
             resp = self.get(search_url, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)['abslist']
+            # --download urls
+            candidates = []
             for search_result in search_results:
-                # --download results
                 if 'MUSICRID' not in search_result:
                     continue
+                library_song_info = self._loadfromlibrary(search_result['MUSICRID'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 params = {'format': 'aac|mp3', 'rid': search_result['MUSICRID'], 'type': 'convert_url', 'response': 'url'}
                 resp = self.get('http://antiserver.kuwo.cn/anti.s', params=params, **request_overrides)
                 if not isvalidresp(resp): continue
                 download_url = resp.text.strip()
                 if (not download_url) or (not (download_url.startswith('http://') or download_url.startswith('https://'))):
                     continue
-                download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
+                candidates.append((search_result, download_url))
+            # --validate the download urls of the whole page at once
+            inspections = self._audiolinktester().inspectmany([download_url for _, download_url in candidates], request_overrides)
+            for (search_result, download_url), inspection in zip(candidates, inspections):
+                # --download results
+                download_url_status, download_result = AudioLinkTester.splitinspection(inspection)
                 if not download_url_status['ok']: continue
-                try:
-                    download_result = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
-                except:
-                    download_result = {'download_url': download_url, 'file_size': 'NULL', 'ext': 'NULL'}
                 if download_result['ext'] == 'NULL':
                     download_result['ext'] = download_url.split('.')[-1].split('?')[0] or 'mp3'
                 duration = seconds2hms(search_result.get('DURATION', '0'))
@@ -104,6 +109,6 @@ class KuwoMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
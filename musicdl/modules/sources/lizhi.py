@@ -9,14 +9,14 @@ WeChat Official Account (微信公众号):
 import os
 import copy
 from .base import BaseMusicClient
-from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import legalizestring, resp2json, seconds2hms, usesearchheaderscookies, AudioLinkTester, WhisperLRC
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+from ..utils import BaseEventSink, AudioLinkTester, legalizestring, resp2json, seconds2hms, usesearchheaderscookies, WhisperLRC
 
 
 '''LizhiMusicClient'''
 class LizhiMusicClient(BaseMusicClient):
     source = 'LizhiMusicClient'
+    cursor_paging = True
     def __init__(self, **kwargs):
         super(LizhiMusicClient, self).__init__(**kwargs)
         self.default_search_headers = {
@@ -41,44 +41,48 @@ class LizhiMusicClient(BaseMusicClient):
         while self.search_size_per_source > count:
             page_rule = copy.deepcopy(default_rule)
             page_rule['page'] = int(count // page_size)
-            if len(search_urls) > 0:
-                try:
-                    resp = self.get(search_urls[-1], **request_overrides)
-                    receipt_data = resp2json(resp)['receiptData']
-                except:
-                    receipt_data = ""
-                page_rule['receiptData'] = receipt_data
             search_urls.append(base_url + urlencode(page_rule))
             count += page_size
-        # return
+        # return, the receiptData of every page after the first one is filled in by _fetchsearchpage from the previous response
         return search_urls
+    '''_fetchsearchpage'''
+    def _fetchsearchpage(self, search_url: str, cursor: str = None, request_overrides: dict = None):
+        request_overrides = request_overrides or {}
+        if cursor:
+            parts = urlsplit(search_url)
+            search_url = urlunsplit(parts._replace(query=urlencode({**dict(parse_qsl(parts.query, keep_blank_values=True)), 'receiptData': cursor})))
+        resp = self.get(search_url, **request_overrides)
+        resp.raise_for_status()
+        search_payload = resp2json(resp)
+        return search_url, search_payload, search_payload.get('receiptData') or None
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0,
+                search_payload: dict = None):
         # init
         request_overrides = request_overrides or {}
         # successful
         try:
-            # --search results
-            resp = self.get(search_url, **request_overrides)
-            resp.raise_for_status()
-            search_results = resp2json(resp)['data']
+            # --search results, already fetched by the cursor pipeline unless called on its own
+            if search_payload is None: search_payload = self._fetchsearchpage(search_url, None, request_overrides)[1]
+            search_results = search_payload['data']
             for search_result in search_results:
                 # --download results
                 if ('userInfo' not in search_result) or ('voiceInfo' not in search_result) or ('voicePlayProperty' not in search_result) or ('voiceId' not in search_result['voiceInfo']):
                     continue
+                library_song_info = self._loadfromlibrary(search_result['voiceInfo']['voiceId'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 download_url = search_result['voicePlayProperty'].get('trackUrl', '')
                 if not download_url: continue
-                for quality in ['_ud.mp3', '_hd.mp3', '_sd.m4a']:
-                    download_url = download_url[:-7] + quality
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                    if download_url_status['ok']: break
-                if not download_url_status['ok']: continue
+                download_url, inspection = self._resolveladder(
+                    [download_url[:-7] + quality for quality in ['_ud.mp3', '_hd.mp3', '_sd.m4a']],
+                    lambda candidate_url, cancel_event: self._audiolinktester().inspect(candidate_url, request_overrides),
+                )
+                if download_url is None: continue
+                download_url_status, download_result = AudioLinkTester.splitinspection(inspection)
                 duration = seconds2hms(search_result['voiceInfo'].get('duration', '0'))
-                try:
-                    download_result = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
-                except:
-                    download_result = {'download_url': download_url, 'file_size': 'NULL', 'ext': 'NULL'}
                 if download_result['ext'] == 'NULL':
                     download_result['ext'] = download_url.split('.')[-1].split('?')[0] or 'mp3'
                 # --lyric results, WhisperLRC runs very slowly, disable it by default
@@ -108,6 +112,6 @@ class LizhiMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
@@ -8,9 +8,8 @@ WeChat Official Account (微信公众号):
 '''
 import copy
 from .base import BaseMusicClient
-from rich.progress import Progress
 from urllib.parse import urlencode
-from ..utils import byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies
 
 
 '''MiguMusicClient'''
@@ -28,6 +27,8 @@ class MiguMusicClient(BaseMusicClient):
         self._initsession()
     '''_boostquality'''
     def _boostquality(self, song_id, request_overrides):
+        # third-party requests never outlive the boost deadline
+        request_overrides = {'timeout': self.boost_timeout, **(request_overrides or {})}
         # _safefetchfilesize
         def _safefetchfilesize(meta: dict):
             if not isinstance(meta, dict): return 0
@@ -43,7 +44,7 @@ class MiguMusicClient(BaseMusicClient):
         for rate in sorted(safeextractfromdict(download_result, ['data', 'level', 'quality'], []), key=lambda x: _safefetchfilesize(x), reverse=True):
             download_url, file_size, ext = rate.get('url', ''), _safefetchfilesize(rate), str(rate.get('format', 'flac')).lower()
             if not download_url: continue
-            download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
+            download_url_status = self._audiolinktester().test(download_url, request_overrides)
             if download_url_status['ok']: break
         # return
         boost_result = dict(download_result=download_result, download_url=download_url, file_size=file_size, download_url_status=download_url_status, ext=ext)
@@ -69,7 +70,7 @@ class MiguMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # _safefetchfilesize
@@ -84,46 +85,43 @@ class MiguMusicClient(BaseMusicClient):
             resp = self.get(search_url, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)
+            candidates = []
             for search_result in search_results:
-                # --download results
                 if 'copyrightId' not in search_result or 'contentId' not in search_result:
                     continue
-                # ----try to obtain high quality music file infos
-                try:
-                    boost_result = self._boostquality(search_result['contentId'], request_overrides=request_overrides)
-                except:
-                    boost_result = dict()
-                # ----general parse
-                file_size, ext = 'NULL', 'NULL'
+                library_song_info = self._loadfromlibrary(search_result['copyrightId'] + '-' + search_result['contentId'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
+                # ----tiers come with their sizes and formats in audioFormats, so they are ranked without any request
+                rates = []
                 for rate in sorted(search_result.get('audioFormats', []), key=lambda x: int(_safefetchfilesize(x)), reverse=True):
                     if byte2mb(_safefetchfilesize(rate)) == 'NULL' or (not rate.get('formatType', '')) or (not rate.get('resourceType', '')):
                         continue
-                    ext = {'PQ': 'mp3', 'HQ': 'mp3', 'SQ': 'flac', 'ZQ24': 'flac'}.get(rate['formatType'], 'NULL')
-                    file_size = byte2mb(_safefetchfilesize(rate))
                     # 移除固定userId参数，避免账户限制导致的下载时长问题
                     download_url = f"https://app.pd.nf.migu.cn/MIGUM3.0/v1.0/content/sub/listenSong.do?channel=mx&copyrightId={search_result['copyrightId']}&contentId={search_result['contentId']}&toneFlag={rate['formatType']}&resourceType={rate['resourceType']}&netType=00"
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                    if download_url_status['ok']: break
-                try:
-                    download_result = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
-                except:
-                    download_result = {'download_url': download_url, 'file_size': 'NULL', 'ext': 'NULL'}
-                if download_result['ext'] == 'NULL':
-                    download_result['ext'] = ext if (ext and ext != 'NULL') else 'mp3'
-                if download_result['file_size'] == 'NULL':
-                    download_result['file_size'] = file_size
-                # ----boost music quality if possible
-                ext, file_size = download_result['ext'], download_result['file_size']
-                if boost_result and boost_result['download_url'] and boost_result['download_url_status']['ok']:
-                    try: file_size_ori = float(file_size.split(' ')[0])
-                    except: file_size_ori = 0
-                    file_size_imp = boost_result['file_size']
-                    if file_size_imp > file_size_ori:
-                        download_result['boost_result'] = boost_result
-                        download_url, ext, file_size = boost_result['download_url'], boost_result['ext'], f"{boost_result['file_size']} MB"
+                    ext = {'PQ': 'mp3', 'HQ': 'mp3', 'SQ': 'flac', 'ZQ24': 'flac'}.get(rate['formatType'], 'mp3')
+                    rates.append(dict(download_url=download_url, file_size=byte2mb(_safefetchfilesize(rate)), ext=ext, download_url_status={}))
+                # ----high quality music file infos boosted at search time, resolved concurrently with the native links below
+                candidates.append((search_result, rates, self._submitboost(search_result['contentId'], request_overrides)))
+            # --only the best tier of every song is validated (all songs at once), a song falls back to its next tier only if that link fails
+            resolved_rates, pending = {}, [idx for idx, (_, rates, _) in enumerate(candidates) if rates]
+            while pending:
+                heads = [(idx, candidates[idx][1].pop(0)) for idx in pending]
+                download_url_statuses = self._validatelinks([rate['download_url'] for _, rate in heads], request_overrides)
+                for (idx, rate), download_url_status in zip(heads, download_url_statuses):
+                    rate['download_url_status'] = download_url_status
+                    if download_url_status['ok'] or idx not in resolved_rates: resolved_rates[idx] = rate
+                pending = [idx for idx, _ in heads if not resolved_rates[idx]['download_url_status']['ok'] and candidates[idx][1]]
+            boost_results = self._collectboosts([boost_future for _, _, boost_future in candidates])
+            for idx, (search_result, _, _) in enumerate(candidates):
+                # --download results
+                resolved_rate = resolved_rates.get(idx, dict(download_url='', file_size='NULL', ext='mp3', download_url_status={}))
+                download_url, file_size, ext, download_url_status = resolved_rate['download_url'], resolved_rate['file_size'], resolved_rate['ext'], resolved_rate['download_url_status']
+                download_result = dict(download_url=download_url, file_size=file_size, ext=ext)
+                boost_result = boost_results[idx]
                 # ----misc
-                if not download_url: continue
-                if (not download_url_status.get('ok', False)) and (not safeextractfromdict(boost_result, ['download_url_status', 'ok'], False)): continue
+                if not self._keepboostable(download_url_status, boost_result): continue
                 duration = seconds2hms(search_result.get('duration', '0'))
                 # --lyric results
                 lyric_url = safeextractfromdict(search_result, ['ext', 'lrcUrl'], '') or safeextractfromdict(search_result, ['ext', 'mrcUrl'], '') or \
@@ -146,6 +144,7 @@ class MiguMusicClient(BaseMusicClient):
                     album=legalizestring(search_result.get('album', 'NULL'), replace_null_string='NULL'),
                     identifier=search_result['copyrightId'] + '-' + search_result['contentId'],
                 )
+                self._applyboost(song_info, boost_result, boost_id=search_result['contentId'])
                 # --append to song_infos
                 song_infos.append(song_info)
             # --update progress
@@ -153,6 +152,6 @@ class MiguMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
@@ -10,14 +10,15 @@ import json
 import copy
 import random
 from .base import BaseMusicClient
-from rich.progress import Progress
 from ..utils.neteaseutils import EapiCryptoUtils
-from ..utils import byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies
 
 
 '''NeteaseMusicClient'''
 class NeteaseMusicClient(BaseMusicClient):
     source = 'NeteaseMusicClient'
+    volatile_url_params = ('authSecret', 'vuutv')
+    LEVEL_RANKS = {'none': -1, 'standard': 0, 'higher': 1, 'exhigh': 2, 'lossless': 3, 'hires': 4, 'jyeffect': 5, 'sky': 6, 'dolby': 7, 'jymaster': 8}
     def __init__(self, **kwargs):
         super(NeteaseMusicClient, self).__init__(**kwargs)
         self.default_search_headers = {
@@ -32,6 +33,8 @@ class NeteaseMusicClient(BaseMusicClient):
         self._initsession()
     '''_boostquality'''
     def _boostquality(self, song_id, request_overrides):
+        # third-party requests never outlive the boost deadline
+        request_overrides = {'timeout': self.boost_timeout, **(request_overrides or {})}
         # _safefetchfilesize
         def _safefetchfilesize(meta: dict):
             if not isinstance(meta, dict): return 0
@@ -39,21 +42,68 @@ class NeteaseMusicClient(BaseMusicClient):
             file_size = file_size.removesuffix('MB').strip()
             try: return float(file_size)
             except: return 0
-        # parse
-        download_url, download_url_status, file_size, ext = "", dict(), 0, 'flac'
-        for quality in ['jymaster', 'sky', 'jyeffect', 'hires', 'lossless', 'exhigh', 'standard']:
-            resp = self.get(url=f'https://api.cenguigui.cn/api/netease/music_v1.php?id={song_id}&type=json&level={quality}')
-            if not isvalidresp(resp=resp): continue
+        # _resolveboostquality
+        def _resolveboostquality(quality, cancel_event):
+            resp = self.get(url=f'https://api.cenguigui.cn/api/netease/music_v1.php?id={song_id}&type=json&level={quality}', **request_overrides)
+            if not isvalidresp(resp=resp): return None
             download_result = resp2json(resp=resp)
-            if 'data' not in download_result or (_safefetchfilesize(download_result['data']) < 0.01): continue
+            if 'data' not in download_result or (_safefetchfilesize(download_result['data']) < 0.01): return None
             download_url, file_size = download_result['data'].get('url', ''), _safefetchfilesize(download_result['data'])
-            if not download_url: continue
+            if not download_url or cancel_event.is_set(): return None
             ext = download_url.split('.')[-1].split('?')[0]
-            download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-            if download_url_status['ok']: break
+            download_url_status = self._audiolinktester().test(download_url, request_overrides)
+            return dict(ok=download_url_status['ok'], download_result=download_result, download_url=download_url, file_size=file_size, download_url_status=download_url_status, ext=ext)
+        # parse
+        _, resolved = self._resolveladder(['jymaster', 'sky', 'jyeffect', 'hires', 'lossless', 'exhigh', 'standard'], _resolveboostquality)
+        if resolved is None: resolved = dict(download_result=dict(), download_url="", file_size=0, download_url_status=dict(), ext='flac')
         # return
-        boost_result = dict(download_result=download_result, download_url=download_url, file_size=file_size, download_url_status=download_url_status, ext=ext)
+        boost_result = dict(
+            download_result=resolved['download_result'], download_url=resolved['download_url'], file_size=resolved['file_size'], 
+            download_url_status=resolved['download_url_status'], ext=resolved['ext'],
+        )
         return boost_result
+    '''_availablequalities'''
+    def _availablequalities(self, search_result: dict, qualities: list):
+        # the privilege of cloudsearch results tells the best level this account can play / download, higher levels are never requested
+        privilege = search_result.get('privilege')
+        if not isinstance(privilege, dict): return list(qualities)
+        levels = [privilege.get(key) for key in ['plLevel', 'dlLevel'] if privilege.get(key) in self.LEVEL_RANKS]
+        if not levels and privilege.get('maxBrLevel') in self.LEVEL_RANKS: levels = [privilege['maxBrLevel']]
+        if not levels: return list(qualities)
+        max_rank = max(self.LEVEL_RANKS[level] for level in levels)
+        return [quality for quality in qualities if self.LEVEL_RANKS.get(quality, 0) <= max_rank]
+    '''_resolvequalities'''
+    def _resolvequalities(self, song_ids: list, qualities: list, request_overrides: dict = None, song_qualities: dict = None):
+        # the player/url endpoint takes a list of ids, so a whole page is resolved with one call per quality level, 
+        # songs drop out of the ladder once they have a working url and the others keep the result of the lowest level that returned anything,
+        # song_qualities optionally restricts the levels tried for each song
+        request_overrides, song_qualities, resolved_results, pending_song_ids = request_overrides or {}, song_qualities or {}, {}, list(dict.fromkeys(song_ids))
+        for quality in qualities:
+            if not pending_song_ids: break
+            level_song_ids = [song_id for song_id in pending_song_ids if quality in song_qualities.get(song_id, qualities)]
+            if not level_song_ids: continue
+            header = {"os": "pc", "appver": "", "osver": "", "deviceId": "pyncm!"}
+            header["requestId"] = str(random.randrange(20000000, 30000000))
+            params = {
+                'ids': level_song_ids, 'level': quality, 'encodeType': 'flac', 'header': json.dumps(header),
+            }
+            if quality == 'sky': params['immerseType'] = 'c51'
+            params = EapiCryptoUtils.encryptparams(url='https://interface3.music.163.com/eapi/song/enhance/player/url/v1', payload=params)
+            resp = self.post('https://interface3.music.163.com/eapi/song/enhance/player/url/v1', data={"params": params}, **request_overrides)
+            if not isvalidresp(resp): continue
+            download_result: dict = resp2json(resp)
+            if (download_result.get('code') not in [200]) or (not isinstance(download_result.get('data'), list)): continue
+            entries = [entry for entry in download_result['data'] if isinstance(entry, dict) and entry.get('id') in level_song_ids]
+            download_url_statuses = self._validatelinks([entry['url'] for entry in entries if entry.get('url')], request_overrides)
+            for entry in entries:
+                # keep the per-song layout of download_result, i.e., {'code': 200, 'data': [entry]}
+                song_download_result = {**{k: v for k, v in download_result.items() if k != 'data'}, 'data': [entry]}
+                download_url_status = download_url_statuses.pop(0) if entry.get('url') else {}
+                resolved_results[entry['id']] = dict(
+                    ok=bool(download_url_status.get('ok')), download_result=song_download_result, download_url=entry.get('url') or '', download_url_status=download_url_status,
+                )
+            pending_song_ids = [song_id for song_id in pending_song_ids if not resolved_results.get(song_id, {}).get('ok')]
+        return resolved_results
     '''_constructsearchurls'''
     def _constructsearchurls(self, keyword: str, rule: dict = None, request_overrides: dict = None):
         # init
@@ -73,7 +123,7 @@ class NeteaseMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: dict = {}, request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: dict = {}, request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         search_meta = copy.deepcopy(search_url)
@@ -84,49 +134,35 @@ class NeteaseMusicClient(BaseMusicClient):
             resp = self.post(search_url, **search_meta, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)['result']['songs']
+            candidates = []
             for search_result in search_results:
-                # --download results
                 if 'id' not in search_result:
                     continue
-                # ----try to obtain high quality music file infos
-                try:
-                    boost_result = self._boostquality(search_result['id'], request_overrides=request_overrides)
-                except:
-                    boost_result = dict()
+                library_song_info = self._loadfromlibrary(search_result['id'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
+                candidates.append(search_result)
+            # --resolve the whole page with one player/url call per quality level
+            qualties = ["jymaster", "jyeffect", "sky", "hires", "lossless", "exhigh", "standard"]
+            boost_futures = {search_result['id']: self._submitboost(search_result['id'], request_overrides) for search_result in candidates}
+            resolved_results = self._resolvequalities(
+                [search_result['id'] for search_result in candidates], qualties, request_overrides, 
+                song_qualities={search_result['id']: self._availablequalities(search_result, qualties) for search_result in candidates},
+            )
+            boost_results = dict(zip(boost_futures.keys(), self._collectboosts(list(boost_futures.values()))))
+            for search_result in candidates:
+                # --download results
                 # ----general parse
-                qualties, download_result, ext, file_size, download_url_status = ["jymaster", "jyeffect", "sky", "hires", "lossless", "exhigh", "standard"], dict(), 'NULL', 'NULL', {}
-                for quality in qualties:
-                    header = {"os": "pc", "appver": "", "osver": "", "deviceId": "pyncm!"}
-                    header["requestId"] = str(random.randrange(20000000, 30000000))
-                    params = {
-                        'ids': [search_result['id']], 'level': quality, 'encodeType': 'flac', 'header': json.dumps(header),
-                    }
-                    if quality == 'sky': params['immerseType'] = 'c51'
-                    params = EapiCryptoUtils.encryptparams(url='https://interface3.music.163.com/eapi/song/enhance/player/url/v1', payload=params)
-                    resp = self.post('https://interface3.music.163.com/eapi/song/enhance/player/url/v1', data={"params": params}, **request_overrides)
-                    if not isvalidresp(resp):  continue
-                    download_result: dict = resp2json(resp)
-                    if (download_result.get('code') not in [200]) or ('data' not in download_result) or (not download_result['data']) or \
-                       (not isinstance(download_result['data'], list)) or (not isinstance(download_result['data'][0], dict)):
-                        continue
-                    download_url = download_result['data'][0].get('url', '')
-                    if not download_url: continue
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                    if download_url_status['ok']: break
-                # ----boost music quality if possible
-                if boost_result and boost_result['download_url'] and boost_result['download_url_status']['ok']:
-                    try: file_size_ori = float(byte2mb(download_result['data'][0].get('size', '0')).split(' ')[0])
-                    except: file_size_ori = 0
-                    file_size_imp = boost_result['file_size']
-                    if file_size_imp > file_size_ori:
-                        download_result['boost_result'] = boost_result
-                        download_url, ext, file_size = boost_result['download_url'], boost_result['ext'], f"{boost_result['file_size']} MB"
+                resolved = resolved_results.get(search_result['id']) or dict(download_result=dict(), download_url='', download_url_status={})
+                download_result, download_url, download_url_status = resolved['download_result'], resolved['download_url'], resolved['download_url_status']
+                # ----high quality music file infos boosted at search time, resolved concurrently with the native links
+                boost_result = boost_results[search_result['id']]
                 # ----misc
-                if not download_url: continue
-                if (not download_url_status.get('ok', False)) and (not safeextractfromdict(boost_result, ['download_url_status', 'ok'], False)): continue
+                if not self._keepboostable(download_url_status, boost_result): continue
                 duration = seconds2hms(search_result.get('dt', 0) / 1000 if isinstance(search_result.get('dt', 0), (int, float)) else 0)
-                ext = download_result['data'][0].get('type', 'mp3') if ext == 'NULL' else ext
-                file_size = byte2mb(download_result['data'][0].get('size', '0')) if file_size == 'NULL' else file_size
+                ext = safeextractfromdict(download_result, ['data', 0, 'type'], None) or 'mp3'
+                file_size = byte2mb(safeextractfromdict(download_result, ['data', 0, 'size'], '0'))
                 # --lyric results
                 data = {'id': search_result['id'], 'cp': 'false', 'tv': '0', 'lv': '0', 'rv': '0', 'kv': '0', 'yv': '0', 'ytv': '0', 'yrv': '0'}
                 resp = self.post('https://interface3.music.163.com/api/song/lyric', data=data, **request_overrides)
@@ -147,6 +183,7 @@ class NeteaseMusicClient(BaseMusicClient):
                     album=legalizestring(safeextractfromdict(search_result, ['al', 'name'], 'NULL'), replace_null_string='NULL'),
                     identifier=search_result['id'],
                 )
+                self._applyboost(song_info, boost_result, boost_id=search_result['id'])
                 # --append to song_infos
                 song_infos.append(song_info)
             # --update progress
@@ -154,6 +191,6 @@ class NeteaseMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
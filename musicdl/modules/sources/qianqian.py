@@ -11,13 +11,13 @@ import copy
 import hashlib
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, AudioLinkTester, byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies
 
 
 '''QianqianMusicClient'''
 class QianqianMusicClient(BaseMusicClient):
     source = 'QianqianMusicClient'
+    volatile_url_params = ('xcode',)
     def __init__(self, **kwargs):
         super(QianqianMusicClient, self).__init__(**kwargs)
         self.appid = '16073360'
@@ -62,7 +62,7 @@ class QianqianMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -71,10 +71,15 @@ class QianqianMusicClient(BaseMusicClient):
             resp = self.get(search_url, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)['data']['typeTrack']
+            # --download urls
+            candidates = []
             for search_result in search_results:
-                # --download results
                 if 'TSID' not in search_result:
                     continue
+                library_song_info = self._loadfromlibrary(search_result['TSID'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 params = {'TSID': search_result['TSID'], 'appid': self.appid}
                 params = self._addsignandtstoparams(params=params)
                 resp = self.get("https://music.91q.com/v1/song/tracklink", params=params, **request_overrides)
@@ -82,13 +87,17 @@ class QianqianMusicClient(BaseMusicClient):
                 download_result: dict = resp2json(resp)
                 download_url = safeextractfromdict(download_result, ['data', 'path'], '') or safeextractfromdict(download_result, ['data', 'trail_audio_info', 'path'], '')
                 if not download_url: continue
-                download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
+                candidates.append((search_result, download_result, download_url))
+            # --validate the download urls of the whole page at once
+            inspections = self._audiolinktester().inspectmany([download_url for _, _, download_url in candidates], request_overrides)
+            for (search_result, download_result, download_url), inspection in zip(candidates, inspections):
+                # --download results
+                download_url_status, download_result_suppl = AudioLinkTester.splitinspection(inspection)
                 if not download_url_status['ok']: continue
                 file_size = byte2mb(download_result.get('size', '0'))
                 duration = seconds2hms(download_result.get('duration', '0'))
                 ext = download_result.get('format', 'mp3')
                 if file_size == 'NULL':
-                    download_result_suppl = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
                     download_result['download_result_suppl'] = download_result_suppl
                     file_size, ext = download_result_suppl['file_size'], download_result_suppl['ext'] if download_result_suppl['ext'] not in ['NULL'] else ext
                 # --lyric results
@@ -118,6 +127,6 @@ class QianqianMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
@@ -11,23 +11,31 @@ import json
 import time
 import base64
 import random
+import threading
 from .base import BaseMusicClient
-from rich.progress import Progress
-from ..utils.qqutils import QQMusicClientUtils, Device, DEFAULT_VIP_QUALITIES, DEFAULT_QUALITIES
-from ..utils import byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, AudioLinkTester
+from ..utils.qqutils import QQMusicClientUtils, QQMusicDeviceCache, Device, DEFAULT_VIP_QUALITIES, DEFAULT_QUALITIES
+from ..utils import BaseEventSink, byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies
 
 
 '''QQMusicClient'''
 class QQMusicClient(BaseMusicClient):
     source = 'QQMusicClient'
+    volatile_url_params = ('guid', 'vkey', 'uin', 'fromtag', 'src')
     def __init__(self, **kwargs):
         super(QQMusicClient, self).__init__(**kwargs)
         self.uid = '3931641530'
         self.version_info = dict(
             version="13.2.5.8", version_code=13020508,
         )
-        self.device = Device()
-        self.qimei_info = QQMusicClientUtils.obtainqimei(version=self.version_info['version'], device=self.device)
+        # device fingerprint and qimei are reused across runs, fetching a new qimei happens in the background so startup never waits on it
+        self.device_cache = QQMusicDeviceCache()
+        cached = self.device_cache.load(version=self.version_info['version'])
+        if cached is None:
+            self.device, self.qimei_info = Device(), {"q16": "", "q36": "6c9d3cd110abca9b16311cee10001e717614"}
+            threading.Thread(target=self._refreshqimei, daemon=True).start()
+        else:
+            self.device, self.qimei_info, needs_refresh = cached
+            if needs_refresh: threading.Thread(target=self._refreshqimei, daemon=True).start()
         self.default_search_headers = {
             'Referer': 'https://y.qq.com/',
             'Origin': 'https://y.qq.com/',
@@ -39,6 +47,13 @@ class QQMusicClient(BaseMusicClient):
         }
         self.default_headers = self.default_search_headers
         self._initsession()
+    '''_refreshqimei'''
+    def _refreshqimei(self):
+        device = copy.copy(self.device)
+        qimei_info = QQMusicClientUtils.obtainqimei(version=self.version_info['version'], device=device)
+        if not qimei_info.get('q16'): return
+        self.device, self.qimei_info = device, qimei_info
+        self.device_cache.save(self.version_info['version'], device, qimei_info)
     '''_randomsearchid'''
     def _randomsearchid(self):
         e = random.randint(1, 20)
@@ -50,6 +65,76 @@ class QQMusicClient(BaseMusicClient):
     '''_randomguid'''
     def _randomguid(self):
         return "".join(random.choices("abcdef1234567890", k=32))
+    '''_postmodules'''
+    def _postmodules(self, modules: dict, request_overrides: dict = None):
+        # musicu.fcg takes several module requests in one json body and answers each of them under its own key
+        request_overrides = request_overrides or {}
+        rule = {
+            'comm': {
+                'cv': self.version_info['version_code'], 'v': self.version_info['version_code'], 'QIMEI36': self.qimei_info['q36'], 'ct': '11', 
+                'tmeAppID': 'qqmusic', 'format': 'json',  'inCharset': 'utf-8', 'outCharset': 'utf-8', 'uid': self.uid,
+            },
+        }
+        rule.update(modules)
+        resp = self.post('https://u.y.qq.com/cgi-bin/musicu.fcg', json=rule, **request_overrides)
+        if not isvalidresp(resp): return {}
+        results: dict = resp2json(resp)
+        if results.get('code', 'NULL') not in [0]: return {}
+        return results
+    '''_resolvevkeys'''
+    def _resolvevkeys(self, song_ladders: dict, vkey_module: str, request_overrides: dict = None, extra_modules: dict = None):
+        # song_ladders maps song mids to their rungs [(quality, default_file_size), ...] from the best quality to the worst, the vkeys of all songs are
+        # requested for quality_ladder_top_k tiers per musicu.fcg call and songs drop out once one of their links works, 
+        # extra_modules (e.g., lyrics) ride along with the first call and their results are returned as well
+        request_overrides, extra_modules = request_overrides or {}, dict(extra_modules or {})
+        module, method = vkey_module.rsplit('.', 1)
+        qualities = list(dict.fromkeys(rung[0] for rungs in song_ladders.values() for rung in rungs))
+        resolved_results, extra_results, pending_song_mids, batch_size = {}, {}, list(song_ladders.keys()), max(self.quality_ladder_top_k, 1)
+        for start in range(0, max(len(qualities), 1), batch_size):
+            batch_qualities, modules = qualities[start: start + batch_size], {}
+            for idx, quality in enumerate(batch_qualities):
+                song_mids = [song_mid for song_mid in pending_song_mids if quality in dict(song_ladders[song_mid])]
+                if not song_mids: continue
+                modules[f'req_{idx}'] = {
+                    'module': module, 'method': method,
+                    'param': {
+                        'filename': [f"{quality[0]}{song_mid}{song_mid}{quality[1]}" for song_mid in song_mids], 'guid': self._randomguid(), 'songmid': song_mids, 
+                        'songtype': [0] * len(song_mids),
+                    },
+                }
+            if not modules and not extra_modules: continue
+            download_result = self._postmodules({**modules, **extra_modules}, request_overrides)
+            if extra_modules: extra_results, extra_modules = {key: download_result.get(key, {}) for key in extra_modules}, {}
+            # candidate links of every song, from the best tier of this batch to the worst
+            candidates = {song_mid: [] for song_mid in pending_song_mids}
+            for idx, quality in enumerate(batch_qualities):
+                key = f'req_{idx}'
+                if key not in modules or safeextractfromdict(download_result, [key, 'code'], 'NULL') not in [0]: continue
+                for item in (safeextractfromdict(download_result, [key, 'data', 'midurlinfo'], []) or []):
+                    song_mid, download_url = item.get('songmid'), item.get('wifiurl') or item.get('purl')
+                    if song_mid not in candidates or not download_url or quality not in dict(song_ladders[song_mid]): continue
+                    candidates[song_mid].append(dict(
+                        download_result={'code': 0, vkey_module: {**download_result[key], 'data': {**download_result[key]['data'], 'midurlinfo': [item]}}},
+                        download_url="https://isure.stream.qqmusic.qq.com/" + download_url, ext=quality[1][1:], file_size=dict(song_ladders[song_mid])[quality],
+                    ))
+            # the best remaining candidate of every song is validated at once, songs whose link fails move on to their next candidate
+            while True:
+                heads = [(song_mid, candidates[song_mid].pop(0)) for song_mid in pending_song_mids if candidates.get(song_mid)]
+                if not heads: break
+                download_url_statuses = self._validatelinks([candidate['download_url'] for _, candidate in heads], request_overrides)
+                for (song_mid, candidate), download_url_status in zip(heads, download_url_statuses):
+                    candidate.update(dict(ok=download_url_status['ok'], download_url_status=download_url_status))
+                    if not download_url_status['ok']: continue
+                    resolved_results[song_mid], candidates[song_mid] = candidate, []
+            pending_song_mids = [song_mid for song_mid in pending_song_mids if song_mid not in resolved_results]
+            if not pending_song_mids: break
+        return resolved_results, extra_results
+    '''_parselyric'''
+    @staticmethod
+    def _parselyric(lyric: str):
+        if not lyric: return 'NULL'
+        try: return base64.b64decode(lyric).decode('utf-8') or 'NULL'
+        except: return lyric
     '''_constructsearchurls'''
     def _constructsearchurls(self, keyword: str, rule: dict = None, request_overrides: dict = None):
         # init
@@ -78,7 +163,7 @@ class QQMusicClient(BaseMusicClient):
         return search_urls
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: dict = {}, request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: dict = {}, request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         search_meta, request_overrides = copy.deepcopy(search_url), request_overrides or {}
         search_url = search_meta.pop('url')
@@ -88,11 +173,14 @@ class QQMusicClient(BaseMusicClient):
             resp = self.post(search_url, **search_meta, **request_overrides)
             resp.raise_for_status()
             search_results = resp2json(resp)['music.search.SearchCgiService.DoSearchForQQMusicMobile']['data']['body']['item_song']
+            candidates, vip_song_ladders, song_ladders = [], {}, {}
             for search_result in search_results:
-                # --download results
                 if 'mid' not in search_result:
                     continue
-                download_result, download_url, ext, file_size = {}, "", "mp3", "0"
+                library_song_info = self._loadfromlibrary(search_result['mid'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
                 file_size_infos = dict(
                     size_new=safeextractfromdict(search_result, ['file', 'size_new'], ['0', '0', '0', '0', '0']),
                     size_flac=safeextractfromdict(search_result, ['file', 'size_flac'], '0'),
@@ -104,76 +192,44 @@ class QQMusicClient(BaseMusicClient):
                     size_96aac=safeextractfromdict(search_result, ['file', 'size_96aac'], '0'),
                     size_48aac=safeextractfromdict(search_result, ['file', 'size_48aac'], '0'),
                 )
-                # ----if cookies exits, assume user with vip first
-                if self.default_cookies or request_overrides.get('cookies', {}):
-                    default_vip_rule = {
-                        'comm': {
-                            'cv': self.version_info['version_code'], 'v': self.version_info['version_code'], 'QIMEI36': self.qimei_info['q36'], 'ct': '11', 
-                            'tmeAppID': 'qqmusic', 'format': 'json',  'inCharset': 'utf-8', 'outCharset': 'utf-8', 'uid': self.uid,
-                        }, 
-                        'music.vkey.GetEVkey.CgiGetEVkey': {
-                            'module': 'music.vkey.GetEVkey', 'method': 'CgiGetEVkey', 
-                            'param': {'filename': [], 'guid': self._randomguid(), 'songmid': [search_result['mid']], 'songtype': [0]}
-                        },
-                    }
-                    default_file_sizes = [
-                        file_size_infos['size_new'][0], file_size_infos['size_new'][1], file_size_infos['size_new'][2],
-                        file_size_infos['size_flac'], file_size_infos['size_new'][5], file_size_infos['size_new'][3],
-                        file_size_infos['size_192ogg'], file_size_infos['size_96ogg'],
-                    ]
-                    for quality, default_file_size in zip(list(DEFAULT_VIP_QUALITIES.values()), default_file_sizes):
-                        if download_result and download_url: continue
-                        current_rule = copy.deepcopy(default_vip_rule)
-                        current_rule['music.vkey.GetEVkey.CgiGetEVkey']['param']['filename'] = [f"{quality[0]}{search_result['mid']}{search_result['mid']}{quality[1]}"]
-                        resp = self.post('https://u.y.qq.com/cgi-bin/musicu.fcg', json=current_rule, **request_overrides)
-                        if not isvalidresp(resp): continue
-                        download_result: dict = resp2json(resp)
-                        if download_result.get('code', 'NULL') not in [0] or safeextractfromdict(download_result, ['music.vkey.GetEVkey.CgiGetEVkey', 'code'], 'NULL') not in [0]:
-                            continue
-                        download_url = safeextractfromdict(download_result, ['music.vkey.GetEVkey.CgiGetEVkey', 'data', "midurlinfo", 0, "wifiurl"], "")
-                        if not download_url: continue
-                        download_url = "https://isure.stream.qqmusic.qq.com/" + download_url
-                        ext = quality[1][1:]
-                        file_size = default_file_size
-                        download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                        if download_url_status['ok']: break
-                        download_result, download_url, ext, file_size = {}, "", "mp3", "0"
-                # ----common user in post try
-                if not download_result or not download_url:
-                    default_rule = {
-                        'comm': {
-                            'cv': self.version_info['version_code'], 'v': self.version_info['version_code'], 'QIMEI36': self.qimei_info['q36'], 'ct': '11', 
-                            'tmeAppID': 'qqmusic', 'format': 'json', 'inCharset': 'utf-8', 'outCharset': 'utf-8', 'uid': self.uid,
-                        }, 
-                        'music.vkey.GetVkey.UrlGetVkey': {
-                            'module': 'music.vkey.GetVkey', 'method': 'UrlGetVkey', 
-                            'param': {'filename': [], 'guid': self._randomguid(), 'songmid': [search_result['mid']], 'songtype': [0]}
-                        },
-                    }
-                    default_file_sizes = [
-                        file_size_infos['size_new'][0], file_size_infos['size_new'][1], file_size_infos['size_new'][2],
-                        file_size_infos['size_flac'], file_size_infos['size_new'][5], file_size_infos['size_new'][3],
-                        file_size_infos['size_192ogg'], file_size_infos['size_96ogg'], file_size_infos['size_320mp3'],
-                        file_size_infos['size_128mp3'], file_size_infos['size_192aac'], file_size_infos['size_96aac'],
-                        file_size_infos['size_48aac'],
-                    ]
-                    for quality, default_file_size in zip(list(DEFAULT_QUALITIES.values()), default_file_sizes):
-                        if download_result and download_url: continue
-                        current_rule = copy.deepcopy(default_rule)
-                        current_rule['music.vkey.GetVkey.UrlGetVkey']['param']['filename'] = [f"{quality[0]}{search_result['mid']}{search_result['mid']}{quality[1]}"]
-                        resp = self.post('https://u.y.qq.com/cgi-bin/musicu.fcg', json=current_rule, **request_overrides)
-                        if not isvalidresp(resp): continue
-                        download_result: dict = resp2json(resp)
-                        if download_result.get('code', 'NULL') not in [0] or safeextractfromdict(download_result, ['music.vkey.GetVkey.UrlGetVkey', 'code'], 'NULL') not in [0]:
-                            continue
-                        download_url = safeextractfromdict(download_result, ['music.vkey.GetVkey.UrlGetVkey', 'data', "midurlinfo", 0, "wifiurl"], "")
-                        if not download_url: continue
-                        download_url = "https://isure.stream.qqmusic.qq.com/" + download_url
-                        ext = quality[1][1:]
-                        file_size = default_file_size
-                        download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                        if download_url_status['ok']: break
-                        download_result, download_url, ext, file_size = {}, "", "mp3", "0"
+                default_file_sizes = [
+                    safeextractfromdict(file_size_infos, ['size_new', 0], '0'), safeextractfromdict(file_size_infos, ['size_new', 1], '0'), 
+                    safeextractfromdict(file_size_infos, ['size_new', 2], '0'), file_size_infos['size_flac'], safeextractfromdict(file_size_infos, ['size_new', 5], '0'), 
+                    safeextractfromdict(file_size_infos, ['size_new', 3], '0'), file_size_infos['size_192ogg'], file_size_infos['size_96ogg'], 
+                    file_size_infos['size_320mp3'], file_size_infos['size_128mp3'], file_size_infos['size_192aac'], file_size_infos['size_96aac'], 
+                    file_size_infos['size_48aac'],
+                ]
+                # ----tiers the search payload reports with a zero or absent size do not exist for this song, so no vkey is requested for them
+                vip_song_ladders[search_result['mid']] = [rung for rung in zip(list(DEFAULT_VIP_QUALITIES.values()), default_file_sizes) if byte2mb(rung[1]) != 'NULL']
+                song_ladders[search_result['mid']] = [rung for rung in zip(list(DEFAULT_QUALITIES.values()), default_file_sizes) if byte2mb(rung[1]) != 'NULL']
+                candidates.append((search_result, file_size_infos))
+            # --vkeys and lyrics of the whole page through merged musicu.fcg calls
+            lyric_modules = {
+                f'lyric_{idx}': {
+                    'module': 'music.musichallSong.PlayLyricInfo', 'method': 'GetPlayLyricInfo', 
+                    'param': {'songMID': search_result['mid'], 'crypt': 0, 'ct': 11, 'cv': self.version_info['version_code'], 'qrc': 0, 'trans': 0, 'roma': 0, 'type': 0},
+                } for idx, (search_result, _) in enumerate(candidates)
+            }
+            resolved_results, lyric_results = {}, {}
+            vip_song_ladders = {song_mid: rungs for song_mid, rungs in vip_song_ladders.items() if rungs}
+            # ----if cookies exits, assume user with vip first
+            if vip_song_ladders and (self.default_cookies or request_overrides.get('cookies', {})):
+                resolved_results, lyric_results = self._resolvevkeys(vip_song_ladders, 'music.vkey.GetEVkey.CgiGetEVkey', request_overrides, extra_modules=lyric_modules)
+            # ----common user in post try
+            pending_song_ladders = {song_mid: rungs for song_mid, rungs in song_ladders.items() if song_mid not in resolved_results and rungs}
+            if pending_song_ladders or (candidates and not lyric_results):
+                common_resolved_results, common_lyric_results = self._resolvevkeys(
+                    pending_song_ladders, 'music.vkey.GetVkey.UrlGetVkey', request_overrides, extra_modules=lyric_modules if not lyric_results else None,
+                )
+                resolved_results.update(common_resolved_results)
+                lyric_results = lyric_results or common_lyric_results
+            for idx, (search_result, file_size_infos) in enumerate(candidates):
+                # --download results
+                download_result, download_url, ext, file_size = {}, "", "mp3", "0"
+                resolved = resolved_results.get(search_result['mid'])
+                if resolved is not None:
+                    download_result, download_url, ext, file_size, download_url_status = \
+                        resolved['download_result'], resolved['download_url'], resolved['ext'], resolved['file_size'], resolved['download_url_status']
                 # ----common user in get try
                 if not download_result or not download_url:
                     params = {
@@ -200,29 +256,27 @@ class QQMusicClient(BaseMusicClient):
                     download_url = 'http://ws.stream.qqmusic.qq.com/' + download_url
                     ext = "mp3"
                     file_size = file_size_infos['size_128mp3']
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
+                    download_url_status = self._validatelink(download_url, request_overrides)
                 # ----parse more infos
                 if not download_url: continue
                 if not download_url_status['ok']: continue
                 duration = seconds2hms(search_result.get('interval', '0'))
-                # --lyric results
-                params = {
-                    'songmid': str(search_result['mid']), 'g_tk': '5381', 'loginUin': '0', 'hostUin': '0', 'format': 'json',
-                    'inCharset': 'utf8', 'outCharset': 'utf-8', 'platform': 'yqq'
-                }
-                request_overrides = copy.deepcopy(request_overrides)
-                request_overrides.pop('headers', {})
-                resp = self.get('https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg', headers={'Referer': 'https://y.qq.com/portal/player.html'}, params=params, **request_overrides)
-                if isvalidresp(resp):
-                    lyric_result: dict = resp2json(resp) or {'lyric': ''}
-                    try:
-                        lyric = lyric_result.get('lyric', '')
-                        if not lyric: lyric = 'NULL'
-                        else: lyric = base64.b64decode(lyric).decode('utf-8')
-                    except:
-                        lyric = 'NULL'
-                else:
-                    lyric_result, lyric = {}, "NULL"
+                # --lyric results, folded into the merged musicu.fcg calls above, the legacy endpoint is only a fallback
+                lyric_result = lyric_results.get(f'lyric_{idx}', {})
+                lyric = self._parselyric(safeextractfromdict(lyric_result, ['data', 'lyric'], '')) if safeextractfromdict(lyric_result, ['code'], 'NULL') in [0] else 'NULL'
+                if lyric == 'NULL':
+                    params = {
+                        'songmid': str(search_result['mid']), 'g_tk': '5381', 'loginUin': '0', 'hostUin': '0', 'format': 'json',
+                        'inCharset': 'utf8', 'outCharset': 'utf-8', 'platform': 'yqq'
+                    }
+                    lyric_request_overrides = copy.deepcopy(request_overrides)
+                    lyric_request_overrides.pop('headers', {})
+                    resp = self.get('https://c.y.qq.com/lyric/fcgi-bin/fcg_query_lyric_new.fcg', headers={'Referer': 'https://y.qq.com/portal/player.html'}, params=params, **lyric_request_overrides)
+                    if isvalidresp(resp):
+                        lyric_result: dict = resp2json(resp) or {'lyric': ''}
+                        lyric = self._parselyric(lyric_result.get('lyric', ''))
+                    else:
+                        lyric_result, lyric = {}, "NULL"
                 # --construct song_info
                 song_info = dict(
                     source=self.source, raw_data=dict(search_result=search_result, download_result=download_result, lyric_result=lyric_result), 
@@ -239,6 +293,6 @@ class QQMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
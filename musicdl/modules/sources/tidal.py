@@ -9,26 +9,33 @@ WeChat Official Account (微信公众号):
 import os
 import re
 import copy
+import time
 import aigpy
 import base64
 import tempfile
 import json_repair
 from xml.etree import ElementTree
 from .base import BaseMusicClient
-from rich.progress import Progress
 from urllib.parse import urlencode, urljoin
-from ..utils import legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, touchdir, replacefile, usesearchheaderscookies, usedownloadheaderscookies, AudioLinkTester
+from ..utils import BaseEventSink, QualityLadderResolver, SegmentFetcher, LinkTestCache, legalizestring, byte2mb, resp2json, isvalidresp, seconds2hms, touchdir, replacefile, safeextractfromdict, usesearchheaderscookies, usedownloadheaderscookies
 from ..utils.tidalutils import (
     TIDALTvSession, SearchResult, StreamRespond, StreamUrl, Manifest, Period, AdaptationSet, Representation, SegmentTemplate, SegmentList, SegmentTimelineEntry,
-    decryptfile, decryptsecuritytoken, pyavready, ffmpegready, remuxflacstream, setmetadata
+    createdecryptor, decryptfile, decryptsecuritytoken, pyavready, ffmpegready, remuxflacstream, setmetadata
 )
 
 
 '''TIDALMusicClient'''
 class TIDALMusicClient(BaseMusicClient):
     source = 'TIDALMusicClient'
-    def __init__(self, **kwargs):
+    volatile_url_params = ('Policy', 'Signature', 'Key-Pair-Id', 'token')
+    QUALITIES = [('hi_res_lossless', 'HI_RES_LOSSLESS'), ('high_lossless', 'LOSSLESS'), ('low_320k', 'HIGH'), ('low_96k', 'LOW')]
+    def __init__(self, segment_workers: int = 8, segment_retries: int = 3, segment_reorder_buffer_size: int = 16, playback_cache_ttl: float = 300, **kwargs):
         super(TIDALMusicClient, self).__init__(**kwargs)
+        self.segment_workers = segment_workers
+        self.segment_retries = segment_retries
+        self.segment_reorder_buffer_size = segment_reorder_buffer_size
+        # parsed playback infos hold signed urls, so they are only reused for a short while
+        self.playback_cache = LinkTestCache(max_size=1024, ttl=playback_cache_ttl, negative_ttl=min(60, playback_cache_ttl))
         self.tidal_session = TIDALTvSession(headers={}, cookies=self.default_cookies)
         try:
             self.tidal_session.loadfromcache()
@@ -213,15 +220,69 @@ class TIDALMusicClient(BaseMusicClient):
             count += page_size
         # return
         return search_urls
+    '''_downloadstream'''
+    def _downloadstream(self, stream_url: StreamUrl, save_path: str, request_overrides: dict = None, progress: BaseEventSink = None, song_progress_id: int = 0, chunk_size: int = 1048576):
+        # single-file streams are decrypted chunk by chunk while they are downloaded, so the plaintext is written once and never held in memory as a whole
+        request_overrides = request_overrides or {}
+        decryptor = None if aigpy.string.isNull(stream_url.encryptionKey) else createdecryptor(*decryptsecuritytoken(stream_url.encryptionKey))
+        with self.get(stream_url.urls[0], stream=True, **request_overrides) as resp:
+            resp.raise_for_status()
+            progress.update(song_progress_id, total=int(resp.headers.get('content-length', 0)) + 1)
+            with open(save_path, 'wb') as fp:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    if not chunk: continue
+                    self.bandwidth_limiter.consume(len(chunk))
+                    fp.write(decryptor.decrypt(chunk) if decryptor is not None else chunk)
+                    progress.bytestransferred(song_progress_id, len(chunk))
+        return save_path
+    '''_downloadsegments'''
+    def _downloadsegments(self, stream_url: StreamUrl, save_path: str, request_overrides: dict = None, progress: BaseEventSink = None, song_progress_id: int = 0, song_name: str = ''):
+        # dash streams are split into many segments, they are fetched concurrently over the pooled session and written back in order
+        request_overrides, num_segments, received = request_overrides or {}, len(stream_url.urls), dict(num_segments=0, num_bytes=0, start_time=time.monotonic())
+        # _fetchsegment, a single attempt on the pooled transfer session (keep-alive, auth headers, timeouts), SegmentFetcher is the only retry layer
+        def _fetchsegment(url):
+            with self._transferget(url, **request_overrides) as resp:
+                resp.raise_for_status()
+                self.bandwidth_limiter.consume(len(resp.content))
+                return resp.content
+        # _onsegment
+        def _onsegment(index, num_bytes, elapsed):
+            received['num_segments'] += 1
+            received['num_bytes'] += num_bytes
+            # the total is unknown up front, so it is estimated from the average segment size seen so far
+            progress.update(song_progress_id, total=int(received['num_bytes'] / received['num_segments'] * num_segments) + 1)
+            progress.bytestransferred(song_progress_id, num_bytes)
+            progress.update(
+                song_progress_id, description=f"{self.source}.download >>> {song_name} (Segment {received['num_segments']}/{num_segments}, "
+                f"{byte2mb(num_bytes / elapsed) if elapsed > 0 else 'NULL'}/s, avg {byte2mb(received['num_bytes'] / max(time.monotonic() - received['start_time'], 1e-6))}/s)"
+            )
+        # fetch
+        fetcher = SegmentFetcher(_fetchsegment, max_workers=self.segment_workers, max_retries=self.segment_retries, reorder_buffer_size=self.segment_reorder_buffer_size)
+        with open(save_path, 'wb') as fp:
+            fetcher.fetch(stream_url.urls, fp, on_segment=_onsegment)
+        return fetcher.stats
     '''_download'''
     @usedownloadheaderscookies
-    def _download(self, song_info: dict, request_overrides: dict = None, downloaded_song_infos: list = [], progress: Progress = None, 
+    def _download(self, song_info: dict, request_overrides: dict = None, downloaded_song_infos: list = [], progress: BaseEventSink = None, 
                   song_progress_id: int = 0, songs_progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # success
         try:
             touchdir(song_info['work_dir'])
+            # already in the library, reference it instead of downloading again
+            if song_info.get('library_path') and os.path.exists(song_info['library_path']):
+                save_path = self._constructsavepath(song_info=song_info, ext=os.path.splitext(song_info['library_path'])[-1])
+                self._linkfromlibrary(song_info, save_path)
+                progress.update(song_progress_id, total=1, completed=1)
+                progress.advance(songs_progress_id, 1)
+                downloaded_song_info = copy.deepcopy(song_info)
+                downloaded_song_info['save_path'] = save_path
+                downloaded_song_infos.append(downloaded_song_info)
+                progress.jobdone(song_progress_id, downloaded_song_info, description=f"{self.source}.download >>> {song_info['song_name']} (Success: From Library)")
+                return downloaded_song_infos
+            # playback info and lyrics are resolved for the selected tracks only
+            if not isinstance(song_info.get('download_url'), StreamUrl): self._resolveplayback(song_info, request_overrides)
             # parse basic information
             stream_url: StreamUrl = song_info['download_url']
             download_ext, final_ext = self._guessstreamextension(stream_url=stream_url), song_info['ext']
@@ -236,25 +297,21 @@ class TIDALMusicClient(BaseMusicClient):
             progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Downloading")
             # download music file
             with tempfile.TemporaryDirectory(prefix="musicdl-TIDALMusicClient-track-") as tmpdir:
-                download_part = os.path.join(
-                    tmpdir, f"download{download_ext}.part" if download_ext else "download.part"
-                )
-                tool = aigpy.download.DownloadTool(download_part, stream_url.urls)
-                tool.setUserProgress(None)
-                tool.setPartSize(chunk_size)
-                check, err = tool.start(showProgress=False)
-                assert check
-                decrypted_target = os.path.join(
+                decrypted_path = os.path.join(
                     tmpdir, f"decrypted{download_ext}" if download_ext else "decrypted"
                 )
-                if aigpy.string.isNull(stream_url.encryptionKey):
-                    replacefile(download_part, decrypted_target)
-                    decrypted_path = decrypted_target
+                if len(stream_url.urls) == 1:
+                    self._downloadstream(stream_url, decrypted_path, request_overrides, progress, song_progress_id, chunk_size)
                 else:
-                    key, nonce = decryptsecuritytoken(stream_url.encryptionKey)
-                    decryptfile(download_part, decrypted_target, key, nonce)
-                    os.remove(download_part)
-                    decrypted_path = decrypted_target
+                    encrypted = not aigpy.string.isNull(stream_url.encryptionKey)
+                    download_part = os.path.join(
+                        tmpdir, f"download{download_ext}.part" if download_ext else "download.part"
+                    ) if encrypted else decrypted_path
+                    self._downloadsegments(stream_url, download_part, request_overrides, progress, song_progress_id, song_info['song_name'])
+                    if encrypted:
+                        key, nonce = decryptsecuritytoken(stream_url.encryptionKey)
+                        decryptfile(download_part, decrypted_path, key, nonce, chunk_size=chunk_size)
+                        os.remove(download_part)
                 if remux_required:
                     remux_target = os.path.join(tmpdir, "remux.flac")
                     processed_path, backend_used = remuxflacstream(decrypted_path, remux_target)
@@ -264,28 +321,71 @@ class TIDALMusicClient(BaseMusicClient):
                     else:
                         final_ext = download_ext
                         decrypted_path = decrypted_path
-                save_path, same_name_file_idx = os.path.join(song_info['work_dir'], f"{song_info['song_name']}{final_ext}"), 1
-                while os.path.exists(save_path):
-                    save_path = os.path.join(song_info['work_dir'], f"{song_info['song_name']}_{same_name_file_idx}{final_ext}")
-                    same_name_file_idx += 1
+                save_path = self._constructsavepath(song_info=song_info, ext=final_ext)
                 replacefile(decrypted_path, save_path)
                 setmetadata(track=song_info['raw_data']['search_result'], filepath=save_path, stream=stream_url)
             # update progress
             progress.advance(song_progress_id, 1)
             progress.advance(songs_progress_id, 1)
-            progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Success)")
             downloaded_song_info = copy.deepcopy(song_info)
             downloaded_song_info['save_path'] = save_path
             downloaded_song_info['ext'] = final_ext
             downloaded_song_infos.append(downloaded_song_info)
+            self._savetolibrary(downloaded_song_info, save_path)
+            progress.jobdone(song_progress_id, downloaded_song_info, description=f"{self.source}.download >>> {song_info['song_name']} (Success)")
         # failure
         except Exception as err:
-            progress.update(song_progress_id, description=f"{self.source}.download >>> {song_info['song_name']} (Error: {err})")
+            progress.error(song_progress_id, f"{self.source}.download >>> {song_info['song_name']} (Error: {err})")
         # return
         return downloaded_song_infos
+    '''_resolvequality'''
+    def _resolvequality(self, track_id, quality: tuple, request_overrides: dict = None, cancel_event=None):
+        request_overrides = request_overrides or {}
+        cached = self.playback_cache.get((track_id, quality[1]))
+        if cached is not None: return cached or None
+        params = {"playbackmode": "STREAM", "audioquality": quality[1], "assetpresentation": "FULL",}
+        resp = self._saferequestget(f'https://tidal.com/v1/tracks/{track_id}/playbackinfo', params=params, **request_overrides)
+        if not isvalidresp(resp): return None
+        download_result = aigpy.model.dictToModel(resp2json(resp), StreamRespond())
+        if ("vnd.tidal.bt" not in download_result.manifestMimeType) and ("dash+xml" not in download_result.manifestMimeType):
+            self.playback_cache.set((track_id, quality[1]), {}, ok=False)
+            return None
+        try:
+            download_url = self._parsemanifest(stream_resp=download_result)
+        except:
+            download_url = ''
+        if not download_url or (cancel_event is not None and cancel_event.is_set()): return None
+        download_url_status = self._audiolinktester().test(download_url.urls[0], request_overrides)
+        resolved = dict(ok=download_url_status['ok'], download_result=download_result, download_url=download_url, download_url_status=download_url_status)
+        self.playback_cache.set((track_id, quality[1]), resolved if resolved['ok'] else {}, ok=resolved['ok'])
+        return resolved
+    '''_resolvelyric'''
+    def _resolvelyric(self, track_id, request_overrides: dict = None):
+        request_overrides = request_overrides or {}
+        params = {'countryCode': self.tidal_session.storage.country_code, 'include': 'lyrics'}
+        resp = self._saferequestget(f'https://openapi.tidal.com/v2/tracks/{track_id}', params=params, **request_overrides)
+        if not isvalidresp(resp): return {}, 'NULL'
+        try:
+            lyric_result = resp2json(resp)
+            lyric = lyric_result.get('included', [{}])[0].get('attributes', {}).get('lrcText', 'NULL')
+        except:
+            lyric_result, lyric = {}, 'NULL'
+        return lyric_result, lyric
+    '''_resolveplayback'''
+    def _resolveplayback(self, song_info: dict, request_overrides: dict = None):
+        # walks the quality ladder of a selected track (parsed manifests are cached for a short while) and fetches its lyrics, song_info is updated in place
+        request_overrides, track_id = request_overrides or {}, song_info['identifier']
+        _, resolved = self._resolveladder(self.QUALITIES, lambda quality, cancel_event: self._resolvequality(track_id, quality, request_overrides, cancel_event))
+        if not QualityLadderResolver.isok(resolved): raise RuntimeError(safeextractfromdict(resolved, ['download_url_status', 'reason'], None) or 'No playable stream found')
+        song_info['raw_data']['download_result'] = resolved['download_result']
+        song_info.update(dict(download_url=resolved['download_url'], download_url_status=resolved['download_url_status'], ext=self._guessextension(stream_url=resolved['download_url'])))
+        if not song_info['raw_data'].get('lyric_result'):
+            lyric_result, lyric = self._resolvelyric(track_id, request_overrides)
+            song_info['raw_data']['lyric_result'], song_info['lyric'] = lyric_result, lyric
+        return song_info
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -296,38 +396,15 @@ class TIDALMusicClient(BaseMusicClient):
             search_results = aigpy.model.dictToModel(resp2json(resp=resp), SearchResult()).tracks.items
             for search_result in search_results:
                 if search_result.id is None: continue
-                # --download results
-                download_result, download_url, ext, file_size = {}, "", "m4a", "0"
-                qualities = [('hi_res_lossless', 'HI_RES_LOSSLESS'), ('high_lossless', 'LOSSLESS'), ('low_320k', 'HIGH'), ('low_96k', 'LOW')]
-                for quality in qualities:
-                    params = {"playbackmode": "STREAM", "audioquality": quality[1], "assetpresentation": "FULL",}
-                    resp = self._saferequestget(f'https://tidal.com/v1/tracks/{search_result.id}/playbackinfo', params=params, **request_overrides)
-                    if not isvalidresp(resp): continue
-                    download_result = aigpy.model.dictToModel(resp2json(resp), StreamRespond())
-                    if ("vnd.tidal.bt" not in download_result.manifestMimeType) and ("dash+xml" not in download_result.manifestMimeType): continue
-                    try:
-                        download_url = self._parsemanifest(stream_resp=download_result)
-                    except:
-                        download_url = ''
-                    if not download_url: continue
-                    download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url.urls[0], request_overrides)
-                    if download_url_status['ok']: break
-                    download_result, download_url, ext, file_size = {}, "", "m4a", "0"
-                if not download_url: continue
-                if not download_url_status['ok']: continue
-                ext = self._guessextension(stream_url=download_url)
+                library_song_info = self._loadfromlibrary(search_result.id)
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
+                # --download results, playbackinfo / manifest / lyrics are resolved by _resolveplayback once the track is selected for downloading
+                file_size, download_result, download_url, lyric_result, lyric = "0", {}, "", {}, 'NULL'
+                download_url_status = dict(ok=True, status=0, method="DEFERRED", final_url=None, ctype=None, clen=None, range=None, fmt=None, reason="Playback info resolved at download time")
+                ext = '.flac' if str(getattr(search_result, 'audioQuality', None) or '').upper() in ['HI_RES_LOSSLESS', 'LOSSLESS'] else '.m4a'
                 duration = seconds2hms(search_result.duration)
-                # --lyric results
-                params = {'countryCode': self.tidal_session.storage.country_code, 'include': 'lyrics'}
-                resp = self._saferequestget(f'https://openapi.tidal.com/v2/tracks/{search_result.id}', params=params, **request_overrides)
-                if isvalidresp(resp):
-                    try:
-                        lyric_result = resp2json(resp)
-                        lyric = lyric_result.get('included', [{}])[0].get('attributes', {}).get('lrcText', 'NULL')
-                    except:
-                        lyric_result, lyric = {}, 'NULL'
-                else:
-                    lyric_result, lyric = {}, 'NULL'
                 # --construct song_info
                 song_info = dict(
                     source=self.source, raw_data=dict(search_result=search_result, download_result=download_result, lyric_result=lyric_result), 
@@ -344,6 +421,6 @@ class TIDALMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
         # return
         return song_infos
\ No newline at end of file
@@ -10,19 +10,22 @@ import os
 import re
 import time
 import copy
+import queue
 import base64
+import threading
 import binascii
 import json_repair
 from Crypto.Cipher import AES
 from .base import BaseMusicClient
 from urllib.parse import urlencode
-from rich.progress import Progress
-from ..utils import byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, AudioLinkTester, WhisperLRC
+from concurrent.futures import ThreadPoolExecutor
+from ..utils import BaseEventSink, AudioLinkTester, byte2mb, resp2json, isvalidresp, seconds2hms, legalizestring, safeextractfromdict, usesearchheaderscookies, WhisperLRC
 
 
 '''XimalayaMusicClient'''
 class XimalayaMusicClient(BaseMusicClient):
     source = 'XimalayaMusicClient'
+    volatile_url_params = ('sign', 'timestamp', 'buy_key', 'token', 'duration')
     def __init__(self, **kwargs):
         super(XimalayaMusicClient, self).__init__(**kwargs)
         self.default_search_headers = {
@@ -63,9 +66,116 @@ class XimalayaMusicClient(BaseMusicClient):
             count += page_size
         # return
         return search_urls
+    '''_resolvefromplaypage'''
+    def _resolvefromplaypage(self, track_id, request_overrides: dict = None, cancel_event=None):
+        resp = self.get(f'http://mobile.ximalaya.com/v1/track/ca/playpage/{track_id}', **(request_overrides or {}))
+        if not isvalidresp(resp) or (cancel_event is not None and cancel_event.is_set()): return None
+        download_result: dict = json_repair.loads(resp.text)
+        track_info = safeextractfromdict(download_result, ['trackInfo'], {})
+        qualities = [
+            ('playHqSize', 'playPathHq'), ('playPathAacv164Size', 'playPathAacv164'), ('downloadAacSize', 'downloadAacUrl'), ('playUrl64Size', 'playUrl64'), 
+            ('playUrl32Size', 'playUrl32'), ('downloadSize', 'downloadUrl'), ('playPathAacv224Size', 'playPathAacv224'),
+        ]
+        quality, inspection = self._resolveladder(
+            [quality for quality in qualities if track_info.get(quality[1], '')],
+            lambda quality, cancel_event: self._audiolinktester().inspect(track_info[quality[1]], request_overrides), cancel_event=cancel_event,
+        )
+        if quality is None: return None
+        download_url = track_info[quality[1]]
+        return dict(
+            ok=True, download_result=download_result, download_url=download_url, ext=download_url.split('.')[-1].split('?')[0], file_size=track_info.get(quality[0], '0'),
+            duration=seconds2hms(track_info.get('duration', '0')), download_url_status=AudioLinkTester.splitinspection(inspection)[0],
+        )
+    '''_resolvefrombaseinfo'''
+    def _resolvefrombaseinfo(self, track_id, request_overrides: dict = None, cancel_event=None):
+        params = {"device": "web", "trackId": track_id, "trackQualityLevel": 2}
+        resp = self.get(f"https://www.ximalaya.com/mobile-playpage/track/v3/baseInfo/{int(time.time() * 1000)}", params=params, **(request_overrides or {}))
+        if not isvalidresp(resp) or (cancel_event is not None and cancel_event.is_set()): return None
+        download_result = resp2json(resp)
+        track_info = safeextractfromdict(download_result, ['trackInfo'], {})
+        candidate_urls = [
+            self._decrypturl(encrypted_url.get('url', '')) for encrypted_url in sorted(safeextractfromdict(track_info, ['playUrlList'], []), key=lambda x: int(x['fileSize']), reverse=True)
+        ]
+        download_url, inspection = self._resolveladder(
+            [candidate_url for candidate_url in candidate_urls if candidate_url],
+            lambda candidate_url, cancel_event: self._audiolinktester().inspect(candidate_url, request_overrides), cancel_event=cancel_event,
+        )
+        if download_url is None: return None
+        # baseInfo carries no usable size, the one measured by the winning inspection is kept so the link is not inspected again
+        download_url_status, download_result_suppl = AudioLinkTester.splitinspection(inspection)
+        if download_result_suppl['ext'] == 'NULL': download_result_suppl['ext'] = download_url.split('.')[-1].split('?')[0]
+        download_result['download_result_suppl'] = download_result_suppl
+        return dict(
+            ok=True, download_result=download_result, download_url=download_url, ext=download_result_suppl['ext'], file_size=download_result_suppl['file_size'],
+            duration=seconds2hms(track_info.get('duration', '0')), download_url_status=download_url_status,
+        )
+    '''_parsetrack'''
+    def _parsetrack(self, keyword: str, search_result: dict, request_overrides: dict = None):
+        # resolves one track (a search result or an album track) into a song_info, None if no working link is found
+        request_overrides = request_overrides or {}
+        download_result, download_url, ext, file_size, duration, download_url_status = {}, "", "m4a", "0", "0", {}
+        # ----race http://mobile.ximalaya.com/v1/track/ca/playpage/{trackId} and https://www.ximalaya.com/mobile-playpage/track/v3/baseInfo/, first working link wins
+        resolved = self._raceresolvers([
+            lambda cancel_event: self._resolvefromplaypage(search_result['trackId'], request_overrides, cancel_event),
+            lambda cancel_event: self._resolvefrombaseinfo(search_result['trackId'], request_overrides, cancel_event),
+        ])
+        if resolved is not None:
+            download_result, download_url, ext, file_size, duration, download_url_status = \
+                resolved['download_result'], resolved['download_url'], resolved['ext'], resolved['file_size'], resolved['duration'], resolved['download_url_status']
+        # ----fall back to https://api.cenguigui.cn/api/music/dg_ximalayamusic.php, whose search payload may already carry the url
+        elif search_result.get('url') or ('n' in search_result):
+            download_url = search_result.get('url') or ''
+            download_result = {'url': download_url} if download_url else {}
+            if not download_url:
+                params = {'msg': keyword, 'n': search_result['n'], 'num': self.search_size_per_source, 'type': 'json'}
+                resp = self.get('https://api.cenguigui.cn/api/music/dg_ximalayamusic.php', params=params, **request_overrides)
+                download_result = resp2json(resp)
+                download_url = download_result.get('url', '')
+            if download_url:
+                download_url_status, download_result_suppl = AudioLinkTester.splitinspection(self._audiolinktester().inspect(download_url, request_overrides))
+                if download_result_suppl['ext'] == 'NULL':
+                    download_result_suppl['ext'] = download_url.split('.')[-1].split('?')[0]
+                download_result['download_result_suppl'] = download_result_suppl
+                ext, file_size = download_result_suppl['ext'], download_result_suppl['file_size']
+                duration = '-:-:-'
+            else:
+                download_result, download_url, ext, file_size, duration = {}, "", "m4a", "0", "0"
+        # ----parse more infos
+        if not download_url: return None
+        if not download_url_status['ok']: return None
+        if byte2mb(file_size) == 'NULL' and 'download_result_suppl' not in download_result:
+            try:
+                _, download_result_suppl = AudioLinkTester.splitinspection(self._audiolinktester().inspect(download_url, request_overrides))
+                ext, file_size = download_result_suppl['ext'], download_result_suppl['file_size']
+                download_result['download_result_suppl'] = download_result_suppl
+            except:
+                return None
+        elif 'download_result_suppl' not in download_result:
+            file_size = byte2mb(file_size)
+        # --lyric results
+        try:
+            if os.environ.get('ENABLE_WHISPERLRC', 'False').lower() == 'true':
+                lyric_result = WhisperLRC(model_size_or_path='small').fromurl(
+                    download_url, headers=self.default_download_headers, cookies=self.default_download_cookies, request_overrides=request_overrides
+                )
+                lyric = lyric_result['lyric']
+            else:
+                lyric_result, lyric = dict(), 'NULL'
+        except:
+            lyric_result, lyric = dict(), 'NULL'
+        # --construct song_info
+        song_info = dict(
+            source=self.source, raw_data=dict(search_result=search_result, download_result=download_result, lyric_result=lyric_result), 
+            download_url_status=download_url_status, download_url=download_url, ext=ext, file_size=file_size, 
+            lyric=lyric, duration=duration, song_name=legalizestring(search_result.get('title', 'NULL'), replace_null_string='NULL'), 
+            singers=legalizestring(search_result.get('Nickname', 'NULL'), replace_null_string='NULL'), 
+            album=legalizestring(search_result.get('album_title', 'NULL'), replace_null_string='NULL'),
+            identifier=search_result['trackId'],
+        )
+        return song_info
     '''_search'''
     @usesearchheaderscookies
-    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: Progress = None, progress_id: int = 0):
+    def _search(self, keyword: str = '', search_url: str = '', request_overrides: dict = None, song_infos: list = [], progress: BaseEventSink = None, progress_id: int = 0):
         # init
         request_overrides = request_overrides or {}
         # successful
@@ -78,91 +188,12 @@ class XimalayaMusicClient(BaseMusicClient):
                 # --download results
                 if 'trackId' not in search_result:
                     continue
-                download_result, download_url, ext, file_size, duration = {}, "", "m4a", "0", "0"
-                # ----try http://mobile.ximalaya.com/v1/track/ca/playpage/{trackId} first
-                resp = self.get(f'http://mobile.ximalaya.com/v1/track/ca/playpage/{search_result["trackId"]}', **request_overrides)
-                if isvalidresp(resp):
-                    download_result: dict = json_repair.loads(resp.text)
-                    track_info = safeextractfromdict(download_result, ['trackInfo'], {})
-                    qualities = [
-                        ('playHqSize', 'playPathHq'), ('playPathAacv164Size', 'playPathAacv164'), ('downloadAacSize', 'downloadAacUrl'), ('playUrl64Size', 'playUrl64'), 
-                        ('playUrl32Size', 'playUrl32'), ('downloadSize', 'downloadUrl'), ('playPathAacv224Size', 'playPathAacv224'),
-                    ]
-                    for quality in qualities:
-                        file_size, download_url = track_info.get(quality[0], '0'), track_info.get(quality[1], '')
-                        if not download_url: continue
-                        ext = download_url.split('.')[-1].split('?')[0]
-                        duration = seconds2hms(track_info.get('duration', '0'))
-                        download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                        if download_url_status['ok']: break
-                    if not download_url or not download_url_status['ok']:
-                        download_result, download_url, ext, file_size, duration = {}, "", "m4a", "0", "0"
-                # ----try https://www.ximalaya.com/mobile-playpage/track/v3/baseInfo/ second
-                if not download_result or not download_url:
-                    params = {"device": "web", "trackId": search_result["trackId"], "trackQualityLevel": 2}
-                    resp = self.get(f"https://www.ximalaya.com/mobile-playpage/track/v3/baseInfo/{int(time.time() * 1000)}", params=params, **request_overrides)
-                    download_result = resp2json(resp)
-                    track_info = safeextractfromdict(download_result, ['trackInfo'], {})
-                    for encrypted_url in sorted(safeextractfromdict(track_info, ['playUrlList'], []), key=lambda x: int(x['fileSize']), reverse=True):
-                        download_url = self._decrypturl(encrypted_url.get('url', ''))
-                        if not download_url: continue
-                        ext = download_url.split('.')[-1].split('?')[0]
-                        duration = seconds2hms(track_info.get('duration', '0'))
-                        download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                        if download_url_status['ok']: break
-                    if not download_url or not download_url_status['ok']:
-                        download_result, download_url, ext, file_size, duration = {}, "", "m4a", "0", "0"
-                # ----try https://api.cenguigui.cn/api/music/dg_ximalayamusic.php finally
-                if (not download_result or not download_url) and ('n' in search_result):
-                    params = {'msg': keyword, 'n': search_result['n'], 'num': self.search_size_per_source, 'type': 'json'}
-                    resp = self.get('https://api.cenguigui.cn/api/music/dg_ximalayamusic.php', params=params, **request_overrides)
-                    download_result = resp2json(resp)
-                    download_url = download_result.get('url', '')
-                    if download_url:
-                        try:
-                            download_result_suppl = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
-                        except:
-                            download_result_suppl = {'download_url': download_url, 'file_size': '0', 'ext': 'NULL'}
-                        if download_result_suppl['ext'] == 'NULL':
-                            download_result_suppl['ext'] = download_url.split('.')[-1].split('?')[0]
-                        download_result['download_result_suppl'] = download_result_suppl
-                        download_url_status = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).test(download_url, request_overrides)
-                        ext, file_size = download_result_suppl['ext'], download_result_suppl['file_size']
-                        duration = '-:-:-'
-                    else:
-                        download_result, download_url, ext, file_size, duration = {}, "", "m4a", "0", "0"
-                # ----parse more infos
-                if not download_url: continue
-                if not download_url_status['ok']: continue
-                if byte2mb(file_size) == 'NULL' and 'download_result_suppl' not in download_result:
-                    try:
-                        download_result_suppl = AudioLinkTester(headers=self.default_download_headers, cookies=self.default_download_cookies).probe(download_url, request_overrides)
-                        ext, file_size = download_result_suppl['ext'], download_result_suppl['file_size']
-                        download_result['download_result_suppl'] = download_result_suppl
-                    except:
-                        continue
-                else:
-                    file_size = byte2mb(file_size)
-                # --lyric results
-                try:
-                    if os.environ.get('ENABLE_WHISPERLRC', 'False').lower() == 'true':
-                        lyric_result = WhisperLRC(model_size_or_path='small').fromurl(
-                            download_url, headers=self.default_download_headers, cookies=self.default_download_cookies, request_overrides=request_overrides
-                        )
-                        lyric = lyric_result['lyric']
-                    else:
-                        lyric_result, lyric = dict(), 'NULL'
-                except:
-                    lyric_result, lyric = dict(), 'NULL'
-                # --construct song_info
-                song_info = dict(
-                    source=self.source, raw_data=dict(search_result=search_result, download_result=download_result, lyric_result=lyric_result), 
-                    download_url_status=download_url_status, download_url=download_url, ext=ext, file_size=file_size, 
-                    lyric=lyric, duration=duration, song_name=legalizestring(search_result.get('title', 'NULL'), replace_null_string='NULL'), 
-                    singers=legalizestring(search_result.get('Nickname', 'NULL'), replace_null_string='NULL'), 
-                    album=legalizestring(search_result.get('album_title', 'NULL'), replace_null_string='NULL'),
-                    identifier=search_result['trackId'],
-                )
+                library_song_info = self._loadfromlibrary(search_result['trackId'])
+                if library_song_info is not None:
+                    song_infos.append(library_song_info)
+                    continue
+                song_info = self._parsetrack(keyword, search_result, request_overrides)
+                if song_info is None: continue
                 # --append to song_infos
                 song_infos.append(song_info)
             # --update progress
@@ -170,6 +201,63 @@ class XimalayaMusicClient(BaseMusicClient):
             progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Success)")
         # failure
         except Exception as err:
-            progress.update(progress_id, description=f"{self.source}.search >>> {search_url} (Error: {err})")
+            progress.error(progress_id, f"{self.source}.search >>> {search_url} (Error: {err})")
+        # return
+        return song_infos
+    '''_iteralbumtracks'''
+    def _iteralbumtracks(self, album_id, page_size: int = 30, max_tracks: int = None, request_overrides: dict = None):
+        # yields the track list of an album page by page, tracks are mapped onto the keys of the search results
+        request_overrides, page_num, num_tracks = request_overrides or {}, 1, 0
+        while max_tracks is None or num_tracks < max_tracks:
+            params = {'albumId': album_id, 'pageNum': page_num, 'pageSize': page_size, 'sort': 0}
+            resp = self.get('https://www.ximalaya.com/revision/album/v1/getTracksList', params=params, **request_overrides)
+            if not isvalidresp(resp): return
+            album_result = resp2json(resp)
+            tracks = safeextractfromdict(album_result, ['data', 'tracks'], []) or []
+            if not tracks: return
+            if max_tracks is not None: tracks = tracks[:max_tracks - num_tracks]
+            yield [
+                dict(track, title=track.get('title', 'NULL'), Nickname=track.get('anchorName') or track.get('nickname') or 'NULL', album_title=track.get('albumTitle', 'NULL'))
+                for track in tracks if 'trackId' in track
+            ]
+            num_tracks, page_num = num_tracks + len(tracks), page_num + 1
+            if num_tracks >= int(safeextractfromdict(album_result, ['data', 'trackTotalCount'], 0) or 0): return
+    '''_parsealbumtrack'''
+    def _parsealbumtrack(self, track: dict, request_overrides: dict = None):
+        library_song_info = self._loadfromlibrary(track['trackId'])
+        if library_song_info is not None: return library_song_info
+        try:
+            return self._parsetrack('', track, request_overrides)
+        except Exception as err:
+            self.logger_handle.error(f'{self.source}._parsealbumtrack >>> {track.get("trackId")} (Error: {err})', disable_print=self.disable_print)
+            return None
+    '''downloadalbum'''
+    def downloadalbum(self, album_id, num_threadings=5, request_overrides: dict = None, page_size: int = 30, max_tracks: int = None, prefetch_pages: int = 1):
+        # init
+        request_overrides = request_overrides or {}
+        self.logger_handle.info(f'Start to download album {album_id} using {self.source}.', disable_print=self.disable_print)
+        work_dir = self._constructuniqueworkdir(keyword=f'album{album_id}')
+        # resolving the next pages runs ahead of the downloads by at most prefetch_pages pages, so memory stays bounded for albums of any length
+        pages = queue.Queue(maxsize=max(prefetch_pages, 1))
+        def _resolvepages():
+            try:
+                with ThreadPoolExecutor(max_workers=num_threadings) as pool:
+                    for tracks in self._iteralbumtracks(album_id, page_size=page_size, max_tracks=max_tracks, request_overrides=request_overrides):
+                        page_song_infos = list(pool.map(lambda track: self._parsealbumtrack(track, request_overrides), tracks))
+                        pages.put([song_info for song_info in page_song_infos if song_info is not None])
+            except Exception as err:
+                self.logger_handle.error(f'{self.source}.downloadalbum >>> {album_id} (Error: {err})', disable_print=self.disable_print)
+            finally:
+                pages.put(None)
+        threading.Thread(target=_resolvepages, daemon=True).start()
+        # every resolved page is fed to one running download scheduler as soon as it arrives
+        def _iterpages():
+            while True:
+                page_song_infos = pages.get()
+                if page_song_infos is None: return
+                for song_info in page_song_infos: song_info['work_dir'] = work_dir
+                yield page_song_infos
+        downloaded_song_infos = self.downloadpages(_iterpages(), num_threadings=num_threadings, request_overrides=request_overrides)
+        self.logger_handle.info(f'Finished downloading album {album_id} using {self.source}, valid downloads: {len(downloaded_song_infos)}.', disable_print=self.disable_print)
         # return
-        return song_infos
\ No newline at end of file
+        return downloaded_song_infos
@@ -1,8 +1,18 @@
 '''initialize'''
 from .lyric import WhisperLRC
+from .library import MusicLibrary, BloomFilter
+from .bandwidth import BandwidthLimiter, GLOBAL_BANDWIDTH_LIMITER
+from .downloadqueue import DownloadQueue
+from .workstealing import StealableTransfer, WorkStealingScheduler
+from .ladder import QualityLadderResolver
+from .linkcache import LinkTestCache
+from .lyriccache import LyricCache
+from .circuitbreaker import CircuitBreaker
+from .segmentfetcher import SegmentFetcher
 from .modulebuilder import BaseModuleBuilder
+from .events import BaseEventSink, RichEventSink, JSONLinesEventSink, NullEventSink, EventSinkBuilder, BuildEventSink
 from .logger import LoggerHandle, colorize, printtable, printfullline, smarttrunctable
 from .misc import (
-    AudioLinkTester, legalizestring, touchdir, seconds2hms, byte2mb, cachecookies, resp2json, isvalidresp, safeextractfromdict, replacefile,
+    AudioLinkTester, legalizestring, touchdir, seconds2hms, byte2mb, mb2byte, cachecookies, resp2json, isvalidresp, safeextractfromdict, replacefile,
     usedownloadheaderscookies, useparseheaderscookies, usesearchheaderscookies
 )
\ No newline at end of file
@@ -0,0 +1,69 @@
+'''
+Function:
+    Implementation of BandwidthLimiter, a process-wide download speed cap shared fairly by all transfers
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import time
+import threading
+import collections
+
+
+'''BandwidthLimiter'''
+class BandwidthLimiter():
+    def __init__(self, rate: int = None, quantum: int = 16384, burst: float = 0.25):
+        self.rate = rate
+        self.quantum = quantum
+        self.burst = burst
+        self.tokens = 0.0
+        self.last_refill_time = time.monotonic()
+        self.waiters = collections.deque()
+        self.condition = threading.Condition()
+        self.credits = threading.local()
+    '''setrate'''
+    def setrate(self, rate: int = None):
+        with self.condition:
+            self._refill()
+            self.rate = rate if (rate and rate > 0) else None
+            self.condition.notify_all()
+    '''_refill'''
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            capacity = max(self.rate * self.burst, self.quantum)
+            self.tokens = min(capacity, self.tokens + (now - self.last_refill_time) * self.rate)
+        self.last_refill_time = now
+    '''_acquire'''
+    def _acquire(self, num_bytes: int):
+        # waiters are served strictly in arrival order and every transfer takes exactly one quantum per turn,
+        # so active transfers end up taking turns (round-robin) and share the cap fairly in bytes
+        ticket = object()
+        with self.condition:
+            self.waiters.append(ticket)
+            try:
+                while self.rate:
+                    self._refill()
+                    if self.waiters[0] is ticket:
+                        if self.tokens >= num_bytes:
+                            self.tokens -= num_bytes
+                            return
+                        self.condition.wait(timeout=(num_bytes - self.tokens) / self.rate)
+                    else:
+                        self.condition.wait(timeout=0.5)
+            finally:
+                self.waiters.remove(ticket)
+                self.condition.notify_all()
+    '''consume'''
+    def consume(self, num_bytes: int):
+        if not self.rate: return
+        credit = getattr(self.credits, 'value', 0)
+        while num_bytes > credit:
+            self._acquire(self.quantum)
+            credit += self.quantum
+        self.credits.value = credit - num_bytes
+
+
+'''GLOBAL_BANDWIDTH_LIMITER'''
+GLOBAL_BANDWIDTH_LIMITER = BandwidthLimiter()
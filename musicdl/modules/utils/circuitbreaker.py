@@ -0,0 +1,46 @@
+'''
+Function:
+    Implementation of CircuitBreaker, which stops calling a failing (third-party) service for a while
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import time
+import threading
+
+
+'''CircuitBreaker'''
+class CircuitBreaker():
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 60):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.recovery_timeout = recovery_timeout
+        self.num_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+    '''state'''
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None: return 'closed'
+            return 'half_open' if time.monotonic() - self.opened_at >= self.recovery_timeout else 'open'
+    '''allow'''
+    def allow(self):
+        # closed lets every call through, open rejects them, and once recovery_timeout has passed a single trial call is let through (half open)
+        with self.lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at < self.recovery_timeout or self.probing: return False
+            self.probing = True
+            return True
+    '''recordsuccess'''
+    def recordsuccess(self):
+        with self.lock:
+            self.num_failures, self.opened_at, self.probing = 0, None, False
+    '''recordfailure'''
+    def recordfailure(self):
+        with self.lock:
+            self.num_failures += 1
+            if self.probing or self.num_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
@@ -0,0 +1,104 @@
+'''
+Function:
+    Implementation of DownloadQueue, a durable record of download jobs used for crash recovery
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from platformdirs import user_data_dir
+
+
+'''DownloadQueue'''
+class DownloadQueue():
+    appname = 'musicdl'
+    appauthor = 'zcjin'
+    STATES = ('queued', 'resolving', 'downloading', 'done', 'failed')
+    UNFINISHED_STATES = ('queued', 'resolving', 'downloading')
+    def __init__(self, db_path: str = None, done_ttl: float = 7 * 86400):
+        db_path = db_path or self.defaultpath()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL, identifier TEXT, state TEXT NOT NULL, '
+            'song_info BLOB, save_path TEXT, error TEXT, created_at REAL, updated_at REAL)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS transitions (job_id INTEGER NOT NULL, state TEXT NOT NULL, error TEXT, created_at REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, source)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS transitions_job_id ON transitions (job_id)')
+        self.conn.commit()
+        # finished jobs are only kept for a while, so the queue does not grow without bound
+        if done_ttl is not None: self.prune(older_than=done_ttl)
+    '''defaultpath'''
+    @classmethod
+    def defaultpath(cls):
+        return os.path.join(user_data_dir(appname=cls.appname, appauthor=cls.appauthor), 'download_queue.db')
+    '''enqueue'''
+    def enqueue(self, source: str, song_info: dict):
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT INTO jobs (source, identifier, state, song_info, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (source, str(song_info.get('identifier')), 'queued', pickle.dumps(song_info), now, now)
+            )
+            job_id = cursor.lastrowid
+            self.conn.execute('INSERT INTO transitions (job_id, state, created_at) VALUES (?, ?, ?)', (job_id, 'queued', now))
+            self.conn.commit()
+        return job_id
+    '''transition'''
+    def transition(self, job_id: int, state: str, save_path: str = None, error: str = None, song_info: dict = None):
+        assert state in self.STATES
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'UPDATE jobs SET state = ?, save_path = COALESCE(?, save_path), error = ?, song_info = COALESCE(?, song_info), updated_at = ? WHERE job_id = ?',
+                (state, save_path, error, pickle.dumps(song_info) if song_info is not None else None, now, job_id)
+            )
+            self.conn.execute('INSERT INTO transitions (job_id, state, error, created_at) VALUES (?, ?, ?, ?)', (job_id, state, error, now))
+            self.conn.commit()
+    '''unfinished'''
+    def unfinished(self, source: str = None, include_failed: bool = False):
+        states = self.UNFINISHED_STATES + (('failed',) if include_failed else ())
+        sql = f'SELECT job_id, source, state, song_info FROM jobs WHERE state IN ({",".join("?" * len(states))})'
+        params = list(states)
+        if source is not None:
+            sql += ' AND source = ?'
+            params.append(source)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY job_id', params).fetchall()
+        jobs = []
+        for job_id, job_source, state, song_info in rows:
+            try: song_info = pickle.loads(song_info)
+            except Exception: continue
+            jobs.append(dict(job_id=job_id, source=job_source, state=state, song_info=song_info))
+        return jobs
+    '''unfinishedsources'''
+    def unfinishedsources(self, include_failed: bool = False):
+        states = self.UNFINISHED_STATES + (('failed',) if include_failed else ())
+        with self.lock:
+            rows = self.conn.execute(f'SELECT DISTINCT source FROM jobs WHERE state IN ({",".join("?" * len(states))})', states).fetchall()
+        return [row[0] for row in rows]
+    '''prune'''
+    def prune(self, states: tuple = ('done',), older_than: float = 0):
+        # deletes the jobs (and their transitions) in the given states that were last updated more than older_than seconds ago
+        states, updated_before = tuple(states), time.time() - older_than
+        if not states: return 0
+        with self.lock:
+            condition = f'state IN ({",".join("?" * len(states))}) AND updated_at <= ?'
+            self.conn.execute(f'DELETE FROM transitions WHERE job_id IN (SELECT job_id FROM jobs WHERE {condition})', (*states, updated_before))
+            num_pruned = self.conn.execute(f'DELETE FROM jobs WHERE {condition}', (*states, updated_before)).rowcount
+            self.conn.commit()
+        return num_pruned
+    '''close'''
+    def close(self):
+        with self.lock:
+            self.conn.close()
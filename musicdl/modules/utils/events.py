@@ -0,0 +1,196 @@
+'''
+Function:
+    Implementation of event sinks, which receive search and download progress (rich live display, JSON lines or nothing at all)
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import sys
+import json
+import time
+import threading
+import itertools
+from .modulebuilder import BaseModuleBuilder
+from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn, DownloadColumn, TransferSpeedColumn, TimeRemainingColumn, MofNCompleteColumn
+
+
+'''BaseEventSink'''
+class BaseEventSink():
+    def __init__(self, mode: str = 'download'):
+        assert mode in ['search', 'download']
+        self.mode = mode
+    '''add_task'''
+    def add_task(self, description: str, total: float = None, **kwargs):
+        raise NotImplementedError('not to be implemented')
+    '''update'''
+    def update(self, task_id: int, description: str = None, total: float = None, completed: float = None, advance: float = None, **kwargs):
+        raise NotImplementedError('not to be implemented')
+    '''advance'''
+    def advance(self, task_id: int, advance: float = 1):
+        self.update(task_id, advance=advance)
+    '''getcompleted'''
+    def getcompleted(self, task_id: int):
+        return 0
+    '''resultfound'''
+    def resultfound(self, source: str, song_info: dict):
+        pass
+    '''bytestransferred'''
+    def bytestransferred(self, task_id: int, num_bytes: int):
+        self.advance(task_id, num_bytes)
+    '''jobdone'''
+    def jobdone(self, task_id: int, song_info: dict, description: str = None):
+        if description is not None: self.update(task_id, description=description)
+    '''error'''
+    def error(self, task_id: int, description: str):
+        self.update(task_id, description=description)
+    '''start'''
+    def start(self):
+        pass
+    '''stop'''
+    def stop(self):
+        pass
+    '''enter'''
+    def __enter__(self):
+        self.start()
+        return self
+    '''exit'''
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+'''NullEventSink'''
+class NullEventSink(BaseEventSink):
+    def __init__(self, mode: str = 'download'):
+        super(NullEventSink, self).__init__(mode=mode)
+        self.task_ids = itertools.count()
+    '''add_task'''
+    def add_task(self, description: str, total: float = None, **kwargs):
+        return next(self.task_ids)
+    '''update'''
+    def update(self, task_id: int, description: str = None, total: float = None, completed: float = None, advance: float = None, **kwargs):
+        pass
+    '''advance'''
+    def advance(self, task_id: int, advance: float = 1):
+        pass
+    '''bytestransferred'''
+    def bytestransferred(self, task_id: int, num_bytes: int):
+        pass
+    '''jobdone'''
+    def jobdone(self, task_id: int, song_info: dict, description: str = None):
+        pass
+    '''error'''
+    def error(self, task_id: int, description: str):
+        pass
+
+
+'''RichEventSink'''
+class RichEventSink(BaseEventSink):
+    def __init__(self, mode: str = 'download', refresh_per_second: int = 20):
+        super(RichEventSink, self).__init__(mode=mode)
+        if mode == 'search':
+            self.progress = Progress(TextColumn("{task.description}"), BarColumn(bar_width=None), MofNCompleteColumn(), TimeRemainingColumn())
+        else:
+            columns = [
+                SpinnerColumn(), TextColumn("{task.description}"), BarColumn(bar_width=None), TaskProgressColumn(),
+                DownloadColumn(), TransferSpeedColumn(), TimeRemainingColumn(),
+            ]
+            self.progress = Progress(*columns, refresh_per_second=refresh_per_second, expand=True)
+    '''add_task'''
+    def add_task(self, description: str, total: float = None, **kwargs):
+        return self.progress.add_task(description, total=total, **kwargs)
+    '''update'''
+    def update(self, task_id: int, description: str = None, total: float = None, completed: float = None, advance: float = None, **kwargs):
+        self.progress.update(task_id, description=description, total=total, completed=completed, advance=advance, **kwargs)
+    '''advance'''
+    def advance(self, task_id: int, advance: float = 1):
+        self.progress.advance(task_id, advance)
+    '''getcompleted'''
+    def getcompleted(self, task_id: int):
+        return self.progress.tasks[task_id].completed
+    '''start'''
+    def start(self):
+        self.progress.start()
+    '''stop'''
+    def stop(self):
+        self.progress.stop()
+
+
+'''JSONLinesEventSink'''
+class JSONLinesEventSink(BaseEventSink):
+    def __init__(self, mode: str = 'download', stream=None, bytes_interval: float = 0.5):
+        super(JSONLinesEventSink, self).__init__(mode=mode)
+        self.stream = stream if stream is not None else sys.stdout
+        self.bytes_interval = bytes_interval
+        self.lock = threading.RLock()
+        self.task_ids = itertools.count()
+        self.tasks = {}
+    '''_emit'''
+    def _emit(self, event: str, **kwargs):
+        record = dict(event=event, mode=self.mode, time=time.time(), **kwargs)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+    '''_flushbytes'''
+    def _flushbytes(self, task_id: int, force: bool = False):
+        with self.lock:
+            task = self.tasks[task_id]
+            if task['pending_bytes'] <= 0: return
+            if not force and time.monotonic() - task['last_bytes_time'] < self.bytes_interval: return
+            num_bytes, task['pending_bytes'], task['last_bytes_time'] = task['pending_bytes'], 0, time.monotonic()
+            self._emit('bytes_transferred', task_id=task_id, num_bytes=num_bytes, completed=task['completed'], total=task['total'])
+    '''add_task'''
+    def add_task(self, description: str, total: float = None, **kwargs):
+        with self.lock:
+            task_id = next(self.task_ids)
+            self.tasks[task_id] = dict(description=description, total=total, completed=0, pending_bytes=0, last_bytes_time=time.monotonic())
+        self._emit('task_added', task_id=task_id, description=description, total=total)
+        return task_id
+    '''update'''
+    def update(self, task_id: int, description: str = None, total: float = None, completed: float = None, advance: float = None, **kwargs):
+        with self.lock:
+            task = self.tasks[task_id]
+            if description is not None: task['description'] = description
+            if total is not None: task['total'] = total
+            if completed is not None: task['completed'] = completed
+            if advance is not None: task['completed'] += advance
+    '''getcompleted'''
+    def getcompleted(self, task_id: int):
+        return self.tasks[task_id]['completed']
+    '''resultfound'''
+    def resultfound(self, source: str, song_info: dict):
+        fields = ['identifier', 'song_name', 'singers', 'album', 'file_size', 'duration', 'ext']
+        self._emit('result_found', source=source, song_info={k: song_info.get(k) for k in fields})
+    '''bytestransferred'''
+    def bytestransferred(self, task_id: int, num_bytes: int):
+        with self.lock:
+            task = self.tasks[task_id]
+            task['completed'] += num_bytes
+            task['pending_bytes'] += num_bytes
+            self._flushbytes(task_id)
+    '''jobdone'''
+    def jobdone(self, task_id: int, song_info: dict, description: str = None):
+        super(JSONLinesEventSink, self).jobdone(task_id, song_info, description=description)
+        self._flushbytes(task_id, force=True)
+        self._emit('job_done', task_id=task_id, song_name=song_info.get('song_name'), save_path=song_info.get('save_path'), source=song_info.get('source'))
+    '''error'''
+    def error(self, task_id: int, description: str):
+        super(JSONLinesEventSink, self).error(task_id, description)
+        self._flushbytes(task_id, force=True)
+        self._emit('error', task_id=task_id, description=description)
+    '''stop'''
+    def stop(self):
+        for task_id in list(self.tasks.keys()):
+            self._flushbytes(task_id, force=True)
+
+
+'''EventSinkBuilder'''
+class EventSinkBuilder(BaseModuleBuilder):
+    REGISTERED_MODULES = {
+        'RichEventSink': RichEventSink, 'JSONLinesEventSink': JSONLinesEventSink, 'NullEventSink': NullEventSink,
+    }
+
+
+'''BuildEventSink'''
+BuildEventSink = EventSinkBuilder().build
@@ -0,0 +1,101 @@
+'''
+Function:
+    Implementation of QualityLadderResolver, which tries the top rungs of a quality ladder at once and keeps the best success
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+
+'''QualityLadderResolver'''
+class QualityLadderResolver():
+    def __init__(self, top_k: int = 3):
+        self.top_k = max(int(top_k), 1)
+    '''isok'''
+    @staticmethod
+    def isok(result):
+        return isinstance(result, dict) and bool(result.get('ok', False))
+    '''resolve'''
+    def resolve(self, rungs: list, resolverung, isok=None, parent_cancel_event: threading.Event = None):
+        # rungs are ordered from the highest to the lowest quality, resolverung(rung, cancel_event) returns a result or None,
+        # returns (rung, result) of the highest successful rung, otherwise (None, result of the lowest rung that returned anything),
+        # once parent_cancel_event (e.g., of a lost race) is set no further rung is started
+        isok, rungs = isok or self.isok, list(rungs)
+        if not rungs: return None, None
+        if parent_cancel_event is not None:
+            resolverung = functools.partial(self._resolveunlesscancelled, resolverung, parent_cancel_event)
+        if self.top_k == 1: return self._resolvesequentially(rungs, resolverung, isok)
+        # every rung gets its own cancel event, so rungs below a success can be stopped while the higher ones keep running
+        cancel_events, results, fallback_idx, best_ok_idx = {}, {}, None, None
+        pool = ThreadPoolExecutor(max_workers=min(self.top_k, len(rungs)))
+        try:
+            futures, next_idx, best_pending_idx = {}, 0, 0
+            while True:
+                # keep top_k rungs in flight until some rung succeeds, lower rungs can not beat that success any more
+                while best_ok_idx is None and next_idx < len(rungs) and len(futures) < self.top_k:
+                    cancel_events[next_idx] = threading.Event()
+                    futures[pool.submit(self._saferesolverung, resolverung, rungs[next_idx], cancel_events[next_idx])] = next_idx
+                    next_idx += 1
+                if not futures: break
+                done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+                if parent_cancel_event is not None and parent_cancel_event.is_set(): break
+                for future in done:
+                    idx = futures.pop(future)
+                    results[idx] = future.result()
+                    if results[idx] is not None and (fallback_idx is None or idx > fallback_idx): fallback_idx = idx
+                    if isok(results[idx]) and (best_ok_idx is None or idx < best_ok_idx): best_ok_idx = idx
+                # rungs in flight below the best success so far are cancelled
+                for future, idx in list(futures.items()):
+                    if best_ok_idx is None or idx < best_ok_idx: continue
+                    future.cancel()
+                    cancel_events[idx].set()
+                    futures.pop(future)
+                # a success wins once every higher rung has finished without success
+                while best_pending_idx in results:
+                    if isok(results[best_pending_idx]): return rungs[best_pending_idx], results[best_pending_idx]
+                    best_pending_idx += 1
+        finally:
+            for cancel_event in cancel_events.values(): cancel_event.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return (None, results[fallback_idx]) if fallback_idx is not None else (None, None)
+    '''race'''
+    @staticmethod
+    def race(resolvers: list, isok=None):
+        # runs independent resolvers (resolver(cancel_event) returns a result or None) at once and returns the first success, None if none succeeds
+        isok, resolvers = isok or QualityLadderResolver.isok, list(resolvers)
+        if not resolvers: return None
+        cancel_event = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=len(resolvers))
+        try:
+            futures = [pool.submit(QualityLadderResolver._saferesolverung, lambda resolver, cancel_event: resolver(cancel_event), resolver, cancel_event) for resolver in resolvers]
+            for future in as_completed(futures):
+                if isok(future.result()): return future.result()
+        finally:
+            cancel_event.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return None
+    '''_resolvesequentially'''
+    def _resolvesequentially(self, rungs: list, resolverung, isok):
+        cancel_event, fallback = threading.Event(), None
+        for rung in rungs:
+            result = self._saferesolverung(resolverung, rung, cancel_event)
+            if isok(result): return rung, result
+            if result is not None: fallback = result
+        return None, fallback
+    '''_resolveunlesscancelled'''
+    @staticmethod
+    def _resolveunlesscancelled(resolverung, parent_cancel_event: threading.Event, rung, cancel_event: threading.Event):
+        if parent_cancel_event.is_set(): return None
+        return resolverung(rung, cancel_event)
+    '''_saferesolverung'''
+    @staticmethod
+    def _saferesolverung(resolverung, rung, cancel_event: threading.Event):
+        if cancel_event.is_set(): return None
+        try:
+            return resolverung(rung, cancel_event)
+        except Exception:
+            return None
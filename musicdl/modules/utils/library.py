@@ -0,0 +1,190 @@
+'''
+Function:
+    Implementation of MusicLibrary, a content-addressed store shared across runs
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import os
+import math
+import atexit
+import time
+import shutil
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+
+'''BloomFilter'''
+class BloomFilter():
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+    '''_positions'''
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+    '''add'''
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= (1 << (pos & 7))
+        self.count += 1
+    '''__contains__'''
+    def __contains__(self, key: str):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+    '''save'''
+    def save(self, path: str):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(dict(capacity=self.capacity, error_rate=self.error_rate, count=self.count, bits=bytes(self.bits)), fp)
+        os.replace(tmp_path, path)
+    '''load'''
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as fp:
+            state = pickle.load(fp)
+        bloom_filter = cls(capacity=state['capacity'], error_rate=state['error_rate'])
+        assert len(state['bits']) == len(bloom_filter.bits)
+        bloom_filter.bits, bloom_filter.count = bytearray(state['bits']), state['count']
+        return bloom_filter
+
+
+'''MusicLibrary'''
+class MusicLibrary():
+    instances = {}
+    instances_lock = threading.Lock()
+    def __init__(self, library_dir: str, capacity: int = 1000000, error_rate: float = 0.001):
+        os.makedirs(library_dir, exist_ok=True)
+        self.library_dir = library_dir
+        self.db_path = os.path.join(library_dir, 'library.db')
+        self.bloom_path = os.path.join(library_dir, 'library.bloom')
+        self.lock = threading.RLock()
+        self.flush_interval = 5.0
+        self.last_flush_time = time.time()
+        self.dirty = False
+        self.closed = False
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tracks (source TEXT NOT NULL, identifier TEXT NOT NULL, content_hash TEXT NOT NULL, save_path TEXT NOT NULL, '
+            'song_info BLOB, added_at REAL, PRIMARY KEY (source, identifier))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tracks_content_hash ON tracks (content_hash)')
+        self.conn.commit()
+        # membership filter, rebuilt from sqlite when missing or outgrown
+        try:
+            self.bloom_filter = BloomFilter.load(self.bloom_path)
+        except Exception:
+            self.bloom_filter = None
+        num_tracks = self.conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        if self.bloom_filter is None or self.bloom_filter.count < num_tracks or num_tracks > self.bloom_filter.capacity:
+            self._rebuildfilter(capacity=max(capacity, num_tracks * 2), error_rate=error_rate)
+        # additions made since the last periodic flush are persisted when the interpreter exits
+        atexit.register(self.close)
+    '''getinstance'''
+    @classmethod
+    def getinstance(cls, library_dir: str, **kwargs):
+        # all clients of a process share one library (and bloom filter) per directory, so their flushes never overwrite each other
+        key = os.path.abspath(library_dir)
+        with cls.instances_lock:
+            library = cls.instances.get(key)
+            if library is None or library.closed:
+                library = cls.instances[key] = cls(library_dir=library_dir, **kwargs)
+            return library
+    '''_key'''
+    @staticmethod
+    def _key(source: str, identifier):
+        return f'{source}\x00{identifier}'
+    '''_rebuildfilter'''
+    def _rebuildfilter(self, capacity: int, error_rate: float):
+        with self.lock:
+            self.bloom_filter = BloomFilter(capacity=capacity, error_rate=error_rate)
+            for source, identifier in self.conn.execute('SELECT source, identifier FROM tracks'):
+                self.bloom_filter.add(self._key(source, identifier))
+            self.bloom_filter.save(self.bloom_path)
+    '''contains'''
+    def contains(self, source: str, identifier):
+        if self._key(source, identifier) not in self.bloom_filter: return False
+        return self.lookup(source, identifier) is not None
+    '''lookup'''
+    def lookup(self, source: str, identifier):
+        if self._key(source, identifier) not in self.bloom_filter: return None
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT content_hash, save_path, song_info FROM tracks WHERE source = ? AND identifier = ?', (source, str(identifier))
+            ).fetchone()
+        if row is None or not os.path.exists(row[1]): return None
+        record = dict(source=source, identifier=identifier, content_hash=row[0], save_path=row[1], song_info=pickle.loads(row[2]) if row[2] else None)
+        return record
+    '''lookupbyhash'''
+    def lookupbyhash(self, content_hash: str):
+        with self.lock:
+            rows = self.conn.execute('SELECT save_path FROM tracks WHERE content_hash = ?', (content_hash,)).fetchall()
+        for row in rows:
+            if os.path.exists(row[0]): return row[0]
+        return None
+    '''add'''
+    def add(self, source: str, identifier, content_hash: str, save_path: str, song_info: dict = None):
+        save_path = os.path.abspath(save_path)
+        # the same bytes downloaded under another identifier are kept only once
+        existing_path = self.lookupbyhash(content_hash)
+        if existing_path and os.path.abspath(existing_path) != save_path:
+            try:
+                os.link(existing_path, save_path + '.link')
+                os.replace(save_path + '.link', save_path)
+            except OSError:
+                if os.path.exists(save_path + '.link'): os.remove(save_path + '.link')
+        song_info_blob = None
+        if song_info is not None:
+            try: song_info_blob = pickle.dumps(song_info)
+            except Exception: song_info_blob = None
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tracks (source, identifier, content_hash, save_path, song_info, added_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (source, str(identifier), content_hash, save_path, song_info_blob, time.time())
+            )
+            self.conn.commit()
+            self.bloom_filter.add(self._key(source, identifier))
+            self.dirty = True
+            if time.time() - self.last_flush_time > self.flush_interval: self.flush()
+    '''flush'''
+    def flush(self):
+        with self.lock:
+            if self.closed: return
+            self.bloom_filter.save(self.bloom_path)
+            self.last_flush_time, self.dirty = time.time(), False
+    '''linkto'''
+    @staticmethod
+    def linkto(src_path: str, dest_path: str, overwrite: bool = False):
+        if overwrite and os.path.exists(dest_path): os.remove(dest_path)
+        try:
+            os.link(src_path, dest_path)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(src_path), dest_path)
+            except OSError:
+                shutil.copyfile(src_path, dest_path)
+        return dest_path
+    '''hashfile'''
+    @staticmethod
+    def hashfile(file_path: str, chunk_size: int = 1048576):
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    '''close'''
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            if self.dirty: self.flush()
+            self.conn.close()
+            self.closed = True
+        atexit.unregister(self.close)
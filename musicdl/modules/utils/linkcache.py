@@ -0,0 +1,57 @@
+'''
+Function:
+    Implementation of LinkTestCache, a TTL and LRU bounded cache of link test and probe results
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import copy
+import time
+import threading
+import collections
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+'''LinkTestCache'''
+class LinkTestCache():
+    def __init__(self, max_size: int = 4096, ttl: float = 600, negative_ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    '''normalizeurl'''
+    @staticmethod
+    def normalizeurl(url: str, volatile_params: tuple = ()):
+        # volatile auth params (signatures, expiry stamps, session keys, ...) change on every resolution while the resource stays the same
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return url
+        volatile_params = {param.lower() for param in volatile_params}
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in volatile_params)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+    '''get'''
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return copy.deepcopy(value)
+    '''set'''
+    def set(self, key, value, ok: bool = True):
+        expires_at = time.monotonic() + (self.ttl if ok else self.negative_ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, copy.deepcopy(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    '''clear'''
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,60 @@
+'''
+Function:
+    Implementation of LyricCache, a persistent cache of lyrics keyed by the content hash of a song
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from platformdirs import user_cache_dir
+
+
+'''LyricCache'''
+class LyricCache():
+    appname = 'musicdl'
+    appauthor = 'zcjin'
+    def __init__(self, db_path: str = None, ttl: float = 90 * 86400):
+        if not db_path:
+            db_path = os.path.join(user_cache_dir(appname=self.appname, appauthor=self.appauthor), 'lyrics.db')
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS lyrics (source TEXT NOT NULL, key TEXT NOT NULL, lyric_result BLOB, lyric TEXT, created_at REAL, PRIMARY KEY (source, key))')
+        self.conn.commit()
+    '''get'''
+    def get(self, source: str, key: str):
+        # returns (lyric_result, lyric) or None if nothing fresh is cached
+        with self.lock:
+            row = self.conn.execute('SELECT lyric_result, lyric, created_at FROM lyrics WHERE source = ? AND key = ?', (source, str(key))).fetchone()
+        if row is None or (self.ttl and time.time() - row[2] > self.ttl): return None
+        try:
+            return pickle.loads(row[0]), row[1]
+        except Exception:
+            return None
+    '''set'''
+    def set(self, source: str, key: str, lyric_result: dict, lyric: str):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO lyrics (source, key, lyric_result, lyric, created_at) VALUES (?, ?, ?, ?, ?)',
+                (source, str(key), pickle.dumps(lyric_result), lyric, time.time())
+            )
+            self.conn.commit()
+    '''clear'''
+    def clear(self, source: str = None):
+        with self.lock:
+            if source is None: self.conn.execute('DELETE FROM lyrics')
+            else: self.conn.execute('DELETE FROM lyrics WHERE source = ?', (source,))
+            self.conn.commit()
+    '''close'''
+    def close(self):
+        with self.lock:
+            self.conn.close()
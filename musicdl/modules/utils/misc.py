@@ -18,8 +18,13 @@ import bleach
 import requests
 import functools
 import json_repair
+import hashlib
+import json
 import unicodedata
+import http.cookiejar
 from bs4 import BeautifulSoup
+from .linkcache import LinkTestCache
+from concurrent.futures import ThreadPoolExecutor
 from pathvalidate import sanitize_filepath, sanitize_filename
 
 
@@ -99,6 +104,16 @@ def byte2mb(size: int):
     return size
 
 
+'''mb2byte'''
+def mb2byte(size: str):
+    try:
+        value, unit = str(size).strip().split(' ')
+        size = int(float(value) * {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}[unit.upper()])
+    except:
+        size = None
+    return size
+
+
 '''resp2json'''
 def resp2json(resp: requests.Response):
     if not isinstance(resp, requests.Response): return {}
@@ -186,8 +201,10 @@ class AudioLinkTester(object):
         "audio/mpeg": "mp3", "audio/mp3": "mp3", "audio/mp4": "m4a", "audio/x-m4a": "m4a", "audio/aac": "aac", "audio/wav": "wav", 
         "audio/x-wav": "wav", "audio/flac": "flac", "audio/x-flac": "flac", "audio/ogg": "ogg", "audio/opus": "opus", "audio/x-aac": "ogg",
     }
-    def __init__(self, timeout=(5, 15), headers: dict = None, cookies: dict = None):
-        self.session = requests.Session()
+    def __init__(self, timeout=(5, 15), headers: dict = None, cookies: dict = None, session: requests.Session = None, cache: LinkTestCache = None,
+                 volatile_params: tuple = ()):
+        # pass a session from AudioLinkTester.buildsession() to share keep-alive connections across testers and threads
+        self.session = session if session is not None else self.buildsession()
         self.timeout = timeout
         self.headers = {
             'Accept': '*/*',
@@ -195,6 +212,19 @@ class AudioLinkTester(object):
         }
         self.headers.update(headers or {})
         self.cookies = cookies or {}
+        # results are reused across searches for the same url once volatile_params (auth query params) are stripped
+        self.cache = cache
+        self.volatile_params = volatile_params
+    '''buildsession'''
+    @staticmethod
+    def buildsession(pool_connections: int = 32, pool_maxsize: int = 64):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # cookies are sent per request, never stored, so one session can be shared by testers with different cookies
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        return session
     '''isaudioct'''
     @staticmethod
     def isaudioct(ct: str):
@@ -211,9 +241,97 @@ class AudioLinkTester(object):
         if len(b) >= 2 and b[0] == 0xFF and (b[1] & 0xF0) == 0xF0:
             return "aac/adts"
         return None
+    '''_cached'''
+    def _cached(self, method: str, url: str, request_overrides: dict, func, isok):
+        if self.cache is None: return func(url, request_overrides)
+        # the same url may be authorized differently (headers, cookies, proxies), so those are part of the key, the (possibly rotated) user agent is not
+        request_overrides = request_overrides or {}
+        headers = {key: value for key, value in {**(self.headers or {}), **(request_overrides.get('headers') or {})}.items() if key.lower() != 'user-agent'}
+        request_context = dict(headers=headers, cookies=[self.cookies, request_overrides.get('cookies')], proxies=request_overrides.get('proxies'))
+        request_digest = hashlib.sha1(json.dumps(request_context, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        cache_key = (method, LinkTestCache.normalizeurl(url, self.volatile_params), request_digest)
+        outputs = self.cache.get(cache_key)
+        if outputs is None:
+            outputs = func(url, request_overrides)
+            self.cache.set(cache_key, outputs, ok=isok(outputs))
+        elif 'download_url' in outputs:
+            outputs['download_url'] = url
+        return outputs
     '''probe'''
     def probe(self, url: str, request_overrides: dict = None):
-        request_overrides = request_overrides or {}
+        return self._cached('probe', url, request_overrides, self._probe, lambda outputs: outputs['file_size'] not in ['NULL'])
+    '''test'''
+    def test(self, url: str, request_overrides: dict = None):
+        return self._cached('test', url, request_overrides, self._test, lambda outputs: outputs['ok'])
+    '''inspect'''
+    def inspect(self, url: str, request_overrides: dict = None):
+        return self._cached('inspect', url, request_overrides, self._inspect, lambda outputs: outputs['ok'])
+    '''testmany'''
+    def testmany(self, urls: list, request_overrides: dict = None, max_workers: int = 8):
+        return self._runmany(self.test, urls, request_overrides, max_workers)
+    '''probemany'''
+    def probemany(self, urls: list, request_overrides: dict = None, max_workers: int = 8):
+        return self._runmany(self.probe, urls, request_overrides, max_workers)
+    '''inspectmany'''
+    def inspectmany(self, urls: list, request_overrides: dict = None, max_workers: int = 8):
+        return self._runmany(self.inspect, urls, request_overrides, max_workers)
+    '''_runmany'''
+    def _runmany(self, func, urls: list, request_overrides: dict, max_workers: int):
+        # urls are checked concurrently over the shared session pool, results come back in the order of urls and duplicates are checked once
+        urls = list(urls)
+        unique_urls = list(dict.fromkeys(urls))
+        if len(unique_urls) <= 1 or max_workers <= 1:
+            results = {url: func(url, request_overrides) for url in unique_urls}
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_urls))) as pool:
+                results = dict(zip(unique_urls, pool.map(lambda url: func(url, request_overrides), unique_urls)))
+        return [copy.deepcopy(results[url]) for url in urls]
+    '''splitinspection'''
+    @staticmethod
+    def splitinspection(outputs: dict):
+        # (test-like outputs, probe-like outputs) of AudioLinkTester.inspect
+        test_outputs = {k: outputs[k] for k in ['ok', 'status', 'method', 'final_url', 'ctype', 'clen', 'range', 'fmt', 'reason']}
+        probe_outputs = dict(file_size=outputs['file_size'], ctype=outputs['ctype'] or 'NULL', ext=outputs['ext'], download_url=outputs['download_url'], final_url=outputs['final_url'] or 'NULL')
+        return test_outputs, probe_outputs
+    '''_inspect'''
+    def _inspect(self, url: str, request_overrides: dict = None):
+        # one real "Range: bytes=0-15" GET gives validity, total size, content type and the magic-sniffed format together
+        request_overrides = dict(request_overrides or {})
+        request_overrides['headers'] = {**(request_overrides.get('headers') or self.headers), 'Range': 'bytes=0-15'}
+        if 'timeout' not in request_overrides: request_overrides['timeout'] = self.timeout
+        if 'cookies' not in request_overrides: request_overrides['cookies'] = self.cookies
+        outputs = dict(
+            ok=False, status=0, method="RANGEGET", final_url=None, ctype=None, clen=None, range=None, fmt=None, reason="", file_size='NULL', ext='NULL', download_url=url,
+        )
+        try:
+            with self.session.get(url, stream=True, allow_redirects=True, **request_overrides) as resp:
+                outputs.update(dict(status=resp.status_code, final_url=str(resp.url)))
+                if resp.status_code not in (200, 206):
+                    outputs["reason"] = f"RANGEGET error: response status {resp.status_code}"
+                    return outputs
+                chunk = next(resp.iter_content(chunk_size=16), b"")[:16]
+                resp_headers = resp.headers
+            ctype = resp_headers.get("Content-Type")
+            if ctype in ['image/jpg; charset=UTF-8', 'image/jpg']: ctype = 'audio/mpeg'
+            content_range = resp_headers.get("Content-Range") or ""
+            clen = content_range.split("/")[-1] if (resp.status_code == 206 and content_range) else resp_headers.get("Content-Length")
+            clen = int(clen) if clen and clen.isdigit() else None
+            fmt = self.sniffmagic(chunk)
+            ext = self.CTYPE_TO_EXT.get((ctype or '').lower().split(";", 1)[0].strip()) or {'mp4/m4a': 'm4a', 'aac/adts': 'aac', 'midi': 'NULL'}.get(fmt, fmt) or 'NULL'
+            outputs.update(dict(
+                ctype=ctype, clen=clen, range=(resp.status_code == 206) or bool(content_range) or (resp_headers.get("Accept-Ranges") or "").lower() == "bytes",
+                fmt=fmt, file_size=byte2mb(clen), ext=ext,
+            ))
+            if self.isaudioct(ctype) or fmt:
+                outputs.update(dict(ok=True, reason="RANGEGET success"))
+            else:
+                outputs.update(dict(ok=False, reason="RANGEGET error: Not audio-like (CT/magic)"))
+        except Exception as err:
+            outputs["reason"] = f"RANGEGET error: {err}"
+        return outputs
+    '''_probe'''
+    def _probe(self, url: str, request_overrides: dict = None):
+        request_overrides = dict(request_overrides or {})
         if 'headers' not in request_overrides: request_overrides['headers'] = self.headers
         if 'timeout' not in request_overrides: request_overrides['timeout'] = self.timeout
         if 'cookies' not in request_overrides: request_overrides['cookies'] = self.cookies
@@ -246,9 +364,9 @@ class AudioLinkTester(object):
         except:
             outputs = dict(file_size='NULL', ctype='NULL', ext='NULL', download_url=url, final_url='NULL')
         return outputs
-    '''test'''
-    def test(self, url: str, request_overrides: dict = None):
-        request_overrides = request_overrides or {}
+    '''_test'''
+    def _test(self, url: str, request_overrides: dict = None):
+        request_overrides = dict(request_overrides or {})
         if 'headers' not in request_overrides: request_overrides['headers'] = self.headers
         if 'timeout' not in request_overrides: request_overrides['timeout'] = self.timeout
         if 'cookies' not in request_overrides: request_overrides['cookies'] = self.cookies
@@ -256,6 +374,7 @@ class AudioLinkTester(object):
         # HEAD test
         try:
             resp = self.session.head(url, allow_redirects=True, **request_overrides)
+            resp.close()
             clen = resp.headers.get("Content-Length")
             clen = int(clen) if clen and clen.isdigit() else None
             outputs.update(dict(
@@ -271,13 +390,14 @@ class AudioLinkTester(object):
             outputs["reason"] = f"HEAD error: {err}"
         # RANGEGET test
         try:
-            headers = copy.deepcopy(self.headers)
+            headers = copy.deepcopy(request_overrides['headers'])
             headers["Range"] = "bytes=0-15"
-            resp = self.session.get(url, stream=True, allow_redirects=True, **request_overrides)
+            resp = self.session.get(url, stream=True, allow_redirects=True, **{**request_overrides, 'headers': headers})
             outputs.update(dict(
                 status=resp.status_code, method="RANGEGET", final_url=str(resp.url),
             ))
             if resp.status_code not in (200, 206):
+                resp.close()
                 outputs["reason"] = f"RANGEGET error: response status {resp.status_code}"
                 return outputs
             chunk = b""
@@ -6,6 +6,7 @@ Author:
 WeChat Official Account (微信公众号):
     Charles的皮卡丘
 '''
+import os
 import time
 import orjson
 import base64
@@ -17,7 +18,8 @@ import binascii
 from uuid import uuid4
 from typing import ClassVar, cast
 from datetime import datetime, timedelta
-from dataclasses import dataclass, field
+from platformdirs import user_cache_dir
+from dataclasses import dataclass, field, asdict
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
@@ -116,7 +118,7 @@ class QQMusicClientUtils(object):
         }
     '''obtainqimei'''
     @staticmethod
-    def obtainqimei(version: str, device):
+    def obtainqimei(version: str, device, timeout: float = 10):
         try:
             payload = QQMusicClientUtils.randompayloadbydevice(device, version)
             crypt_key = "".join(random.choices("adbcdef1234567890", k=16))
@@ -135,6 +137,7 @@ class QQMusicClientUtils(object):
                 json={
                     "app": 0, "os": 1, "qimeiParams": {"key": key, "params": params, "time": str(ts), "nonce": nonce, "sign": sign, "extra": extra},
                 },
+                timeout=timeout,
             )
             data = orjson.loads(orjson.loads(resp.content)["data"])["data"]
             device.qimei = data["q36"]
@@ -181,4 +184,44 @@ class Device:
     apn: str = "wifi"
     vendor_name: str = "MIUI"
     vendor_os_name: str = "qmapi"
-    qimei: None | str = None
\ No newline at end of file
+    qimei: None | str = None
+
+
+'''QQMusicDeviceCache'''
+class QQMusicDeviceCache():
+    appname = 'musicdl'
+    appauthor = 'zcjin'
+    def __init__(self, cache_path: str = None, ttl: float = 30 * 86400, refresh_interval: float = 86400):
+        # the device fingerprint and its q16/q36 are kept across runs, entries older than ttl are dropped and entries older than refresh_interval are refreshed
+        if not cache_path:
+            cache_path = os.path.join(user_cache_dir(appname=self.appname, appauthor=self.appauthor), 'qq_device.json')
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+    '''load'''
+    def load(self, version: str):
+        # returns (device, qimei_info, needs_refresh) or None if nothing usable is cached for this app version
+        try:
+            with open(self.cache_path, 'rb') as fp:
+                entry = orjson.loads(fp.read())
+            age = time.time() - entry['saved_at']
+            if entry['version'] != version or age > self.ttl or not entry['qimei_info'].get('q36'): return None
+            device_info = dict(entry['device'])
+            device_info['version'] = OSVersion(**device_info['version'])
+            device = Device(**device_info)
+            return device, entry['qimei_info'], age > self.refresh_interval
+        except Exception:
+            return None
+    '''save'''
+    def save(self, version: str, device: Device, qimei_info: dict):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            entry = {'version': version, 'saved_at': time.time(), 'device': asdict(device), 'qimei_info': qimei_info}
+            tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(orjson.dumps(entry))
+            os.replace(tmp_path, self.cache_path)
+            return True
+        except Exception:
+            return False
+
@@ -0,0 +1,64 @@
+'''
+Function:
+    Implementation of SegmentFetcher, which downloads the segments of a (DASH) stream concurrently and writes them back in order
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+'''SegmentFetcher'''
+class SegmentFetcher():
+    def __init__(self, fetchsegment, max_workers: int = 8, max_retries: int = 3, reorder_buffer_size: int = 16, retry_backoff: float = 0.5):
+        # fetchsegment(url) returns the bytes of one segment and raises on failure
+        self.fetchsegment = fetchsegment
+        self.max_workers = max(int(max_workers), 1)
+        self.max_retries = max(int(max_retries), 0)
+        self.reorder_buffer_size = max(int(reorder_buffer_size), self.max_workers)
+        self.retry_backoff = retry_backoff
+        self.stats = []
+        self.lock = threading.Lock()
+    '''_fetchwithretry'''
+    def _fetchwithretry(self, index: int, url: str):
+        for attempt in range(self.max_retries + 1):
+            start_time = time.monotonic()
+            try:
+                data = self.fetchsegment(url)
+                return data, time.monotonic() - start_time, attempt
+            except Exception:
+                if attempt >= self.max_retries: raise
+                time.sleep(self.retry_backoff * (2 ** attempt))
+    '''fetch'''
+    def fetch(self, urls: list, fp, on_segment=None):
+        # at most reorder_buffer_size segments are in flight or waiting for their predecessors, so memory stays bounded whatever the number of segments,
+        # on_segment(index, num_bytes, elapsed) is called once a segment arrives, its throughput is also kept in self.stats
+        urls = list(urls)
+        with self.lock: self.stats = [None] * len(urls)
+        if not urls: return 0
+        futures, buffered, next_submit, next_write, total_bytes = {}, {}, 0, 0, 0
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls)))
+        try:
+            while next_write < len(urls):
+                while next_submit < len(urls) and next_submit - next_write < self.reorder_buffer_size:
+                    futures[pool.submit(self._fetchwithretry, next_submit, urls[next_submit])] = next_submit
+                    next_submit += 1
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    data, elapsed, retries = future.result()
+                    buffered[index] = data
+                    with self.lock:
+                        self.stats[index] = dict(index=index, size=len(data), elapsed=elapsed, retries=retries, throughput=len(data) / elapsed if elapsed > 0 else float('inf'))
+                    if on_segment is not None: on_segment(index, len(data), elapsed)
+                while next_write in buffered:
+                    data = buffered.pop(next_write)
+                    fp.write(data)
+                    total_bytes += len(data)
+                    next_write += 1
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return total_bytes
@@ -14,6 +14,7 @@ import aigpy
 import base64
 import shutil
 import requests
+import functools
 import webbrowser
 import subprocess
 from .misc import resp2json
@@ -573,6 +574,7 @@ def buildsegmenttemplate(template: SegmentTemplate, base_url: str, representatio
 
 
 '''decryptsecuritytoken'''
+@functools.lru_cache(maxsize=256)
 def decryptsecuritytoken(security_token):
     master_key = 'UIlTTEMmmLfGowo/UC60x2H45W6MdGgTRfo/umg4754='
     master_key = base64.b64decode(master_key)
@@ -586,14 +588,19 @@ def decryptsecuritytoken(security_token):
     return key, nonce
 
 
-'''decryptfile'''
-def decryptfile(efile, dfile, key, nonce):
+'''createdecryptor'''
+def createdecryptor(key, nonce):
+    # AES-CTR keeps its keystream position between decrypt calls, so data can be fed in chunks of any size as it arrives
     counter = Counter.new(64, prefix=nonce, initial_value=0)
-    decryptor = AES.new(key, AES.MODE_CTR, counter=counter)
-    with open(efile, 'rb') as eflac:
-        flac = decryptor.decrypt(eflac.read())
-        with open(dfile, 'wb') as dflac:
-            dflac.write(flac)
+    return AES.new(key, AES.MODE_CTR, counter=counter)
+
+
+'''decryptfile'''
+def decryptfile(efile, dfile, key, nonce, chunk_size: int = 1048576):
+    decryptor = createdecryptor(key, nonce)
+    with open(efile, 'rb') as eflac, open(dfile, 'wb') as dflac:
+        for chunk in iter(lambda: eflac.read(chunk_size), b''):
+            dflac.write(decryptor.decrypt(chunk))
 
 
 '''ffmpegready'''
@@ -0,0 +1,143 @@
+'''
+Function:
+    Implementation of WorkStealingScheduler, a download pool whose idle workers take over byte ranges of large files that are still running
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+'''StealableTransfer'''
+class StealableTransfer():
+    def __init__(self, total_size: int, fetchsegment, min_segment_size: int = 4194304):
+        # fetchsegment(start, end) downloads bytes [start, end) into the destination file and raises on failure
+        self.total_size = total_size
+        self.fetchsegment = fetchsegment
+        self.min_segment_size = min_segment_size
+        self.position = 0
+        self.end = total_size
+        self.segments = []
+        self.finished = False
+        self.lock = threading.Lock()
+    '''remaining'''
+    def remaining(self):
+        return self.end - self.position
+    '''claim'''
+    def claim(self, num_bytes: int):
+        # the owner claims the next bytes of its own stream before writing them, so a split never hands out bytes it already has
+        with self.lock:
+            num_bytes = max(min(num_bytes, self.end - self.position), 0)
+            self.position += num_bytes
+            return num_bytes
+    '''split'''
+    def split(self):
+        with self.lock:
+            remaining = self.end - self.position
+            if self.finished or remaining < 2 * self.min_segment_size: return None
+            start = self.position + remaining // 2
+            segment = dict(start=start, end=self.end, done=threading.Event(), error=None)
+            self.end = start
+            self.segments.append(segment)
+            return segment
+    '''runsegment'''
+    def runsegment(self, segment: dict):
+        try:
+            self.fetchsegment(segment['start'], segment['end'])
+        except Exception as err:
+            segment['error'] = err
+        finally:
+            segment['done'].set()
+    '''wait'''
+    def wait(self):
+        # called by the owner once its own stream is exhausted, segments whose thief failed are fetched again by the owner
+        with self.lock:
+            self.finished = True
+        for segment in self.segments:
+            segment['done'].wait()
+            if segment['error'] is not None: self.fetchsegment(segment['start'], segment['end'])
+        return len(self.segments)
+
+
+'''WorkStealingScheduler'''
+class WorkStealingScheduler():
+    local = threading.local()
+    def __init__(self, num_workers: int = 5, idle_interval: float = 0.1, enable_stealing: bool = True):
+        self.num_workers = max(int(num_workers), 1)
+        self.enable_stealing = enable_stealing
+        self.idle_interval = idle_interval
+        self.transfers = []
+        self.lock = threading.Lock()
+    '''current'''
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, 'scheduler', None)
+    '''register'''
+    def register(self, transfer: StealableTransfer):
+        with self.lock:
+            self.transfers.append(transfer)
+    '''unregister'''
+    def unregister(self, transfer: StealableTransfer):
+        with self.lock:
+            if transfer in self.transfers: self.transfers.remove(transfer)
+    '''steal'''
+    def steal(self):
+        with self.lock:
+            transfers = sorted(self.transfers, key=lambda transfer: transfer.remaining(), reverse=True)
+        for transfer in transfers:
+            segment = transfer.split()
+            if segment is not None: return transfer, segment
+        return None
+    '''run'''
+    def run(self, jobs, runjob):
+        # jobs are taken in the given order, workers left without jobs help the largest running transfer,
+        # jobs can also be any iterable (e.g., a generator resolving an album page by page), which is drained by a feeder thread while earlier jobs run
+        streaming = not isinstance(jobs, (list, tuple, collections.deque))
+        if not streaming and not jobs: return
+        state = dict(queued=collections.deque() if streaming else collections.deque(jobs), num_pending=0 if streaming else len(jobs), exhausted=not streaming, error=None)
+        jobs_lock = threading.Condition()
+        def _feed():
+            try:
+                for job in jobs:
+                    with jobs_lock:
+                        # at most num_workers jobs wait in the queue, so the iterable is only consumed as fast as jobs are taken
+                        while len(state['queued']) >= self.num_workers: jobs_lock.wait()
+                        state['queued'].append(job)
+                        state['num_pending'] += 1
+            except Exception as err:
+                state['error'] = err
+            finally:
+                with jobs_lock: state['exhausted'] = True
+        def _worker():
+            self.local.scheduler = self
+            try:
+                while True:
+                    with jobs_lock:
+                        job = state['queued'].popleft() if state['queued'] else None
+                        if job is not None: jobs_lock.notify_all()
+                    if job is not None:
+                        try:
+                            runjob(job)
+                        finally:
+                            with jobs_lock: state['num_pending'] -= 1
+                        continue
+                    stolen = self.steal() if self.enable_stealing else None
+                    if stolen is not None:
+                        stolen[0].runsegment(stolen[1])
+                        continue
+                    with jobs_lock:
+                        if state['exhausted'] and state['num_pending'] <= 0: return
+                    time.sleep(self.idle_interval)
+            finally:
+                self.local.scheduler = None
+        # with stealing (or streamed jobs), the whole pool is started even for fewer jobs than workers, so idle workers can take over the tails of large files from the start
+        num_workers = self.num_workers if (self.enable_stealing or streaming) else min(self.num_workers, len(jobs))
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            if streaming: threading.Thread(target=_feed, daemon=True).start()
+            futures = [pool.submit(_worker) for _ in range(num_workers)]
+            for future in futures: future.result()
+        if state['error'] is not None: raise state['error']
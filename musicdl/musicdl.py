@@ -6,6 +6,7 @@ Author:
 WeChat Official Account (微信公众号):
     Charles的皮卡丘
 '''
+import os
 import sys
 import copy
 import click
@@ -13,10 +14,10 @@ import json_repair
 import concurrent.futures
 if __name__ == '__main__':
     from __init__ import __version__
-    from modules import BuildMusicClient, LoggerHandle, MusicClientBuilder, smarttrunctable, colorize, printfullline
+    from modules import BuildMusicClient, LoggerHandle, MusicClientBuilder, DownloadQueue, GLOBAL_BANDWIDTH_LIMITER, smarttrunctable, colorize, printfullline
 else:
     from .__init__ import __version__
-    from .modules import BuildMusicClient, LoggerHandle, MusicClientBuilder, smarttrunctable, colorize, printfullline
+    from .modules import BuildMusicClient, LoggerHandle, MusicClientBuilder, DownloadQueue, GLOBAL_BANDWIDTH_LIMITER, smarttrunctable, colorize, printfullline
 
 
 '''BASIC_INFO'''
@@ -33,10 +34,14 @@ Music Files Save Path:
 
 '''MusicClient'''
 class MusicClient():
-    def __init__(self, music_sources: list = [], init_music_clients_cfg: dict = {}, clients_threadings: dict = {}, requests_overrides: dict = {}, search_rules: dict = {}):
+    def __init__(self, music_sources: list = [], init_music_clients_cfg: dict = {}, clients_threadings: dict = {}, requests_overrides: dict = {}, search_rules: dict = {},
+                 bandwidth_limit: int = None):
         # assert
         assert isinstance(music_sources, list) and isinstance(init_music_clients_cfg, dict) and isinstance(clients_threadings, dict) and \
                isinstance(requests_overrides, dict) and isinstance(search_rules, dict)
+        # event sinks may hold caller-owned streams (e.g., an open file), they are handed to the clients by reference instead of being deep-copied
+        event_sinks = {source: cfg['event_sink'] for source, cfg in init_music_clients_cfg.items() if isinstance(cfg, dict) and cfg.get('event_sink') is not None}
+        init_music_clients_cfg = {source: ({k: v for k, v in cfg.items() if k != 'event_sink'} if isinstance(cfg, dict) else cfg) for source, cfg in init_music_clients_cfg.items()}
         music_sources, init_music_clients_cfg, clients_threadings, requests_overrides, search_rules = \
             copy.deepcopy(music_sources), copy.deepcopy(init_music_clients_cfg), copy.deepcopy(clients_threadings), copy.deepcopy(requests_overrides), copy.deepcopy(search_rules)
         # set attributes
@@ -53,10 +58,12 @@ class MusicClient():
             init_music_client_cfg = {
                 'search_size_per_source': 5, 'auto_set_proxies': False, 'random_update_ua': False, 'max_retries': 5,
                 'maintain_session': False, 'logger_handle': self.logger_handle, 'disable_print': True, 'work_dir': 'musicdl_outputs',
-                'proxy_sources': None, 'default_search_cookies': {}, 'default_download_cookies': {}, 'type': music_source
+                'proxy_sources': None, 'default_search_cookies': {}, 'default_download_cookies': {}, 'library_dir': None, 'event_sink': 'RichEventSink' if sys.stdout.isatty() else None,
+                'type': music_source,
             }
             init_music_client_cfg.update(init_music_clients_cfg.get(music_source, {}))
             self.music_clients[music_source] = BuildMusicClient(module_cfg=init_music_client_cfg)
+            if music_source in event_sinks: self.music_clients[music_source].event_sink = event_sinks[music_source]
             self.work_dirs[music_source] = init_music_client_cfg['work_dir']
             if music_source not in self.clients_threadings:
                 self.clients_threadings[music_source] = 5
@@ -64,6 +71,11 @@ class MusicClient():
                 self.requests_overrides[music_source] = {}
             if music_source not in self.search_rules:
                 self.search_rules[music_source] = {}
+        # global download speed cap (bytes/sec) fairly shared by all concurrent downloads
+        if bandwidth_limit is not None: self.setbandwidthlimit(bandwidth_limit)
+    '''setbandwidthlimit'''
+    def setbandwidthlimit(self, bandwidth_limit: int = None):
+        GLOBAL_BANDWIDTH_LIMITER.setrate(bandwidth_limit)
     '''printbasicinfo'''
     def printbasicinfo(self):
         printfullline(ch='-')
@@ -150,6 +162,18 @@ class MusicClient():
             self.music_clients[source].download(
                 song_infos=source_song_infos, num_threadings=self.clients_threadings[source], request_overrides=self.requests_overrides[source]
             )
+    '''resume'''
+    def resume(self, include_failed: bool = False):
+        resumed_song_infos = []
+        for music_source in self.music_sources:
+            if music_source not in self.music_clients: continue
+            resumed_song_infos.extend(self.music_clients[music_source].resume(
+                num_threadings=self.clients_threadings[music_source], request_overrides=self.requests_overrides[music_source], include_failed=include_failed,
+            ))
+        return resumed_song_infos
+    '''close'''
+    def close(self):
+        for music_client in self.music_clients.values(): music_client.close()
     '''processinputs'''
     def processinputs(self, input_tip='', prefix: str = '\n'):
         # accept user inputs
@@ -170,7 +194,7 @@ class MusicClient():
 
 
 '''MusicClientCMD'''
-@click.command()
+@click.group(invoke_without_command=True)
 @click.version_option()
 @click.option(
     '-k', '--keyword', default=None, help='The keywords for the music search. If left empty, an interactive terminal will open automatically.', type=str, show_default=True,
@@ -190,7 +214,11 @@ class MusicClient():
 @click.option(
     '-s', '--search-rules', '--search_rules', default=None, help='Search rules for each music client as a JSON string.', type=str, show_default=True,
 )
-def MusicClientCMD(keyword: str, music_sources: str, init_music_clients_cfg: str, requests_overrides: str, clients_threadings: str, search_rules: str):
+@click.option(
+    '-b', '--bandwidth-limit', '--bandwidth_limit', default=None, help='Global download speed cap in bytes per second shared by all downloads, unlimited if left empty.', type=int, show_default=True,
+)
+@click.pass_context
+def MusicClientCMD(ctx: click.Context, keyword: str, music_sources: str, init_music_clients_cfg: str, requests_overrides: str, clients_threadings: str, search_rules: str, bandwidth_limit: int):
     # load json string
     def _safe_load(string):
         if string is not None:
@@ -202,11 +230,18 @@ def MusicClientCMD(keyword: str, music_sources: str, init_music_clients_cfg: str
     requests_overrides = _safe_load(requests_overrides)
     clients_threadings = _safe_load(clients_threadings)
     search_rules = _safe_load(search_rules)
+    # subcommands such as `musicdl resume` build their own music client
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = dict(
+            init_music_clients_cfg=init_music_clients_cfg, requests_overrides=requests_overrides, clients_threadings=clients_threadings,
+            search_rules=search_rules, bandwidth_limit=bandwidth_limit,
+        )
+        return
     # instance music client
     music_sources = music_sources.replace(' ', '').split(',')
     music_client = MusicClient(
         music_sources=music_sources, init_music_clients_cfg=init_music_clients_cfg, clients_threadings=clients_threadings, 
-        requests_overrides=requests_overrides, search_rules=search_rules,
+        requests_overrides=requests_overrides, search_rules=search_rules, bandwidth_limit=bandwidth_limit,
     )
     # switch according to keyword
     if keyword is None:
@@ -220,6 +255,44 @@ def MusicClientCMD(keyword: str, music_sources: str, init_music_clients_cfg: str
             song_infos.extend(song_infos_per_source)
         # --download
         music_client.download(song_infos=song_infos)
+        music_client.close()
+
+
+'''MusicClientResumeCMD'''
+@MusicClientCMD.command(name='resume')
+@click.option(
+    '--retry-failed', '--retry_failed', is_flag=True, default=False, help='Also retry download jobs that previously failed.', show_default=True,
+)
+@click.pass_obj
+def MusicClientResumeCMD(cfg: dict, retry_failed: bool):
+    """Continue unfinished download jobs recorded by previous runs, re-resolving expired download urls."""
+    logger_handle, init_music_clients_cfg = LoggerHandle(), cfg.get('init_music_clients_cfg') or {}
+    # every source reads the queue it was configured with, the same way its music client would
+    queue_sources = {}
+    for music_source in MusicClientBuilder.REGISTERED_MODULES.keys():
+        init_music_client_cfg = init_music_clients_cfg.get(music_source, {})
+        if not init_music_client_cfg.get('enable_download_queue', True): continue
+        queue_path = os.path.abspath(init_music_client_cfg.get('download_queue_path') or DownloadQueue.defaultpath())
+        queue_sources.setdefault(queue_path, set()).add(music_source)
+    music_sources = []
+    for queue_path, sources in queue_sources.items():
+        if not os.path.exists(queue_path): continue
+        download_queue = DownloadQueue(db_path=queue_path)
+        music_sources.extend([music_source for music_source in download_queue.unfinishedsources(include_failed=retry_failed) if music_source in sources])
+        download_queue.close()
+    if not music_sources:
+        logger_handle.info('No unfinished download jobs to resume.')
+        return
+    music_client = MusicClient(music_sources=music_sources, **cfg)
+    music_client.resume(include_failed=retry_failed)
+    music_client.close()
+    # jobs finished by this run are not needed for crash recovery any more
+    for queue_path in queue_sources.keys():
+        if not os.path.exists(queue_path): continue
+        download_queue = DownloadQueue(db_path=queue_path)
+        num_pruned = download_queue.prune(older_than=0)
+        download_queue.close()
+        if num_pruned: logger_handle.info(f'Pruned {num_pruned} finished download jobs from {queue_path}.')
 
 
 '''tests'''
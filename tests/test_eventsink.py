@@ -0,0 +1,35 @@
+'''
+Function:
+    Tests of the event sinks built by BaseMusicClient
+Author:
+    Zhenchao Jin
+WeChat Official Account (微信公众号):
+    Charles的皮卡丘
+'''
+import json
+from musicdl.modules.sources.base import BaseMusicClient
+
+
+'''test_jsonlineseventsink_writes_to_caller_owned_file'''
+def test_jsonlineseventsink_writes_to_caller_owned_file(tmp_path):
+    events_path = tmp_path / 'events.jsonl'
+    with open(events_path, 'w', encoding='utf-8') as fp:
+        client = BaseMusicClient(work_dir=str(tmp_path / 'outputs'), enable_download_queue=False, event_sink={'type': 'JSONLinesEventSink', 'stream': fp})
+        with client._buildeventsink(mode='download') as progress:
+            assert progress.stream is fp
+            task_id = progress.add_task('song', total=10)
+            progress.bytestransferred(task_id, 10)
+            progress.error(task_id, 'failed')
+    with open(events_path, 'r', encoding='utf-8') as fp:
+        events = [json.loads(line) for line in fp if line.strip()]
+    assert events and all(event['mode'] == 'download' for event in events)
+    assert 'error' in [event['event'] for event in events]
+
+
+'''test_disable_print_defaults_to_nulleventsink'''
+def test_disable_print_defaults_to_nulleventsink(tmp_path, monkeypatch):
+    monkeypatch.setattr('sys.stdout.isatty', lambda: True)
+    client = BaseMusicClient(work_dir=str(tmp_path / 'outputs'), enable_download_queue=False, disable_print=True)
+    assert type(client._buildeventsink(mode='search')).__name__ == 'NullEventSink'
+    client.event_sink = 'RichEventSink'
+    assert type(client._buildeventsink(mode='search')).__name__ == 'RichEventSink'